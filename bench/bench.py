@@ -0,0 +1,364 @@
+# Load test of the whole telerun pipeline on one machine, without GPUs.
+#
+# Starts the queue server on localhost with a temporary database and a self-signed certificate,
+# and real executors whose 'nvcc' is a stub which produces stub binaries, then drives them with
+# simulated clients which submit jobs and wait for their results the way submit.py does. Reports
+# throughput, submit-to-result latency, the server's CPU time and the size of its database.
+#
+# Requires the 'openssl' command line tool, to create the certificate.
+
+import argparse
+import importlib.util
+import json
+import os
+import secrets
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+queue_dir = os.path.join(repo_dir, "queue")
+executor_path = os.path.join(repo_dir, "executor", "executor.py")
+submit_path = os.path.join(repo_dir, "client", "submit.py")
+
+sys.path.insert(0, queue_dir)
+import submission_queue.db as db
+
+# How long to wait for the server to start accepting connections.
+server_start_timeout = 30 # seconds
+
+# How long to give the executors to start up before the clients start submitting jobs.
+executor_start_delay = 2 # seconds
+
+# How long to wait for processes to exit after asking them to stop, before killing them.
+stop_timeout = 10 # seconds
+
+def load_submit_module():
+    # The client is a standalone script rather than a package, so it is loaded from its path.
+    spec = importlib.util.spec_from_file_location("submit", submit_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def write_stub_nvcc(bin_dir, compile_delay, execute_delay, output_size):
+    # Writes a stub 'nvcc' which takes 'compile_delay' seconds to "compile" a program into a shell
+    # script, which takes 'execute_delay' seconds to print 'output_size' bytes.
+    os.makedirs(bin_dir, exist_ok=True)
+    nvcc_path = os.path.join(bin_dir, "nvcc")
+    with open(nvcc_path, "w") as f:
+        f.write(f"""#!/bin/sh
+if [ "$1" = "--version" ]; then
+    echo "stub nvcc for benchmarking"
+    exit 0
+fi
+out=""
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-o" ]; then
+        out="$2"
+        shift
+    fi
+    shift
+done
+sleep {compile_delay}
+cat > "$out" <<'EOF'
+#!/bin/sh
+sleep {execute_delay}
+head -c {output_size} /dev/zero | tr '\\000' x
+EOF
+chmod +x "$out"
+""")
+    os.chmod(nvcc_path, 0o755)
+
+def create_certificate(cert_dir):
+    certfile = os.path.join(cert_dir, "server.crt")
+    keyfile = os.path.join(cert_dir, "server.key")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509",
+            "-newkey", "rsa:2048", "-nodes",
+            "-keyout", keyfile,
+            "-out", certfile,
+            "-days", "1",
+            "-subj", "/CN=localhost",
+            "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1",
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return certfile, keyfile
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile of a sorted, non-empty list.
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+class Cluster:
+    # A queue server and executors running on localhost, in a temporary directory.
+
+    def __init__(self, work_dir, nusers, nexecutors, nproc_compile, nproc_execute, server_args=[], executor_args=[]):
+        self.work_dir = work_dir
+        self.port = free_port()
+        self.address = f"127.0.0.1:{self.port}"
+        self.certfile, self.keyfile = create_certificate(work_dir)
+        self.db_path = os.path.join(work_dir, "db.sqlite3")
+
+        # Create the accounts directly in the temporary database.
+        con = db.connect_to_db(self.db_path)
+        self.users = [(f"bench-user-{i}", secrets.token_hex(32)) for i in range(nusers)]
+        executors = [(f"bench-executor-{i}", secrets.token_hex(32)) for i in range(nexecutors)]
+        # An admin account, for reading the server's metrics.
+        self.admin = ("bench-admin", secrets.token_hex(32))
+        con.executemany("INSERT INTO users (username, token) VALUES (?, ?)", self.users)
+        con.executemany("INSERT INTO executors (name, token) VALUES (?, ?)", executors)
+        con.execute("INSERT INTO admins (name, token) VALUES (?, ?)", self.admin)
+        con.commit()
+        con.close()
+
+        self.server = subprocess.Popen(
+            [
+                sys.executable, "-m", "submission_queue.main",
+                "--host", "127.0.0.1",
+                "--port", str(self.port),
+                "--db", self.db_path,
+                "--certfile", self.certfile,
+                "--keyfile", self.keyfile,
+                "--audit-log", os.path.join(work_dir, "audit_log.jsonl"),
+                *server_args,
+            ],
+            cwd=queue_dir,
+            stdout=open(os.path.join(work_dir, "server.log"), "w"),
+            stderr=subprocess.STDOUT,
+        )
+        self.wait_for_server()
+
+        env = {**os.environ, "PATH": os.path.join(work_dir, "bin") + os.pathsep + os.environ["PATH"]}
+        self.executors = []
+        for name, token in executors:
+            executor_dir = os.path.join(work_dir, name)
+            os.makedirs(executor_dir)
+            auth_path = os.path.join(executor_dir, "auth.json")
+            with open(auth_path, "w") as f:
+                json.dump({"executor": name, "token": token}, f)
+            self.executors.append(subprocess.Popen(
+                [
+                    sys.executable, executor_path,
+                    "--nproc-compile", str(nproc_compile),
+                    "--nproc-execute", str(nproc_execute),
+                    "--auth", auth_path,
+                    "--server", self.address,
+                    "--server-cert", self.certfile,
+                    "--scratch-dir", executor_dir,
+                    "--metrics-log-interval", "0",
+                    *executor_args,
+                ],
+                env=env,
+                # The executor's workers are stopped along with it, as a process group.
+                start_new_session=True,
+                stdout=open(os.path.join(executor_dir, "executor.log"), "w"),
+                stderr=subprocess.STDOUT,
+            ))
+        time.sleep(executor_start_delay)
+
+    def wait_for_server(self):
+        deadline = time.monotonic() + server_start_timeout
+        while True:
+            if self.server.poll() is not None:
+                raise RuntimeError(f"The queue server exited; see {os.path.join(self.work_dir, 'server.log')}")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def connect(self, submit):
+        # Returns a connection pool to the server, using the client's HTTP code.
+        with open(self.certfile, "r") as f:
+            ssl_ctx = ssl.create_default_context(cadata=f.read())
+        return submit.ConnectionPool(self.address, ssl_ctx, max_idle=1)
+
+    def db_size(self):
+        return sum(
+            os.path.getsize(self.db_path + suffix)
+            for suffix in ("", "-wal", "-journal")
+            if os.path.exists(self.db_path + suffix)
+        )
+
+    def stop(self):
+        # Stops everything, and returns the CPU time used by the queue server, in seconds.
+        for executor in self.executors:
+            try:
+                os.killpg(executor.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            executor.wait()
+        self.server.terminate()
+        deadline = time.monotonic() + stop_timeout
+        while True:
+            pid, status, rusage = os.wait4(self.server.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            if time.monotonic() > deadline:
+                self.server.kill()
+                pid, status, rusage = os.wait4(self.server.pid, 0)
+                break
+            time.sleep(0.05)
+        # The process has been reaped here, so don't let Popen try again.
+        self.server.returncode = status
+        return rusage.ru_utime + rusage.ru_stime
+
+def wait_for_result(submit, pool, username, token, job_id):
+    # Waits for the job to complete the way submit.py does without live output, and returns its
+    # result, or None if the job was deleted.
+    state = "pending"
+    while True:
+        response = submit.api_request(
+            pool,
+            "GET",
+            "status",
+            {"username": username, "token": token, "job_id": job_id, "wait": submit.status_wait, "state": state},
+            timeout=submit.status_wait + 30,
+        )
+        state = response["state"]
+        if state is None:
+            return None
+        if state == "complete":
+            return submit.api_request(pool, "GET", "result", {"username": username, "token": token, "job_id": job_id})["result"]
+
+def run_client(cluster, submit, username, token, njobs, source_size, latencies, failures):
+    # Submits 'njobs' jobs one after another, as one user, appending each job's submit-to-result
+    # latency to 'latencies'.
+    pool = cluster.connect(submit)
+    for i in range(njobs):
+        # Every source is distinct, so that the executors' compile cache never hits.
+        source = f"// {username} job {i}\n".ljust(source_size, " ")
+        started = time.monotonic()
+        try:
+            job_id = submit.submit_job(username, token, source, pool)
+            if job_id is None:
+                raise RuntimeError("The user already has a pending job")
+            result = wait_for_result(submit, pool, username, token, job_id)
+            if result is None or not result["success"]:
+                raise RuntimeError(f"Job {job_id} failed: {result}")
+        except Exception as e:
+            failures.append(str(e))
+            continue
+        latencies.append(time.monotonic() - started)
+
+def compare(results, baseline, config):
+    differences = [key for key, value in config.items() if key in baseline and baseline[key] != value]
+    if differences:
+        print()
+        print("Note: the baseline was run with different settings:", ", ".join(differences))
+    print()
+    print(f"{'':<24}{'baseline':>14}{'change':>10}")
+    for key, value in results.items():
+        if not isinstance(value, (int, float)) or not baseline.get(key):
+            continue
+        change = (value - baseline[key]) / baseline[key] * 100
+        print(f"{key:<24}{baseline[key]:>14.4g}{change:>+9.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the queue server and executors on localhost, without GPUs")
+    parser.add_argument("--clients", type=int, default=8, help="Number of simulated clients, each a separate user (default: 8)")
+    parser.add_argument("--jobs-per-client", type=int, default=10, help="Number of jobs each client submits, one after another (default: 10)")
+    parser.add_argument("--executors", type=int, default=1, help="Number of executors (default: 1)")
+    parser.add_argument("--nproc-compile", type=int, default=1, help="Compile workers per executor (default: 1)")
+    parser.add_argument("--nproc-execute", type=int, default=1, help="Execution workers per executor (default: 1)")
+    parser.add_argument("--compile-delay", type=float, default=0, help="Seconds the stub nvcc takes per job (default: 0)")
+    parser.add_argument("--execute-delay", type=float, default=0, help="Seconds each stub binary runs for (default: 0)")
+    parser.add_argument("--output-size", type=int, default=1024, help="Bytes of output each stub binary prints (default: 1024)")
+    parser.add_argument("--source-size", type=int, default=4096, help="Bytes of source code per job (default: 4096)")
+    parser.add_argument("--server-args", default="", help="Extra arguments for the queue server, as one string")
+    parser.add_argument("--executor-args", default="", help="Extra arguments for each executor, as one string")
+    parser.add_argument("--json", help="Write the results to this file, to use as a baseline later")
+    parser.add_argument("--baseline", help="Compare the results with those written by an earlier run with --json")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary directory, with the database and logs")
+    args = parser.parse_args()
+
+    submit = load_submit_module()
+    work_dir = tempfile.mkdtemp(prefix="telerun-bench-")
+    write_stub_nvcc(os.path.join(work_dir, "bin"), args.compile_delay, args.execute_delay, args.output_size)
+
+    cluster = None
+    try:
+        cluster = Cluster(
+            work_dir,
+            args.clients,
+            args.executors,
+            args.nproc_compile,
+            args.nproc_execute,
+            args.server_args.split(),
+            args.executor_args.split(),
+        )
+
+        latencies = []
+        failures = []
+        threads = [
+            threading.Thread(
+                target=run_client,
+                args=(cluster, submit, username, token, args.jobs_per_client, args.source_size, latencies, failures),
+            )
+            for username, token in cluster.users
+        ]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+    finally:
+        if cluster is not None:
+            server_cpu = cluster.stop()
+            db_size = cluster.db_size()
+        if args.keep:
+            print("Kept", work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    latencies.sort()
+    results = {
+        "jobs": len(latencies),
+        "failures": len(failures),
+        "seconds": elapsed,
+        "jobs_per_second": len(latencies) / elapsed,
+        "latency_p50": percentile(latencies, 50) if latencies else None,
+        "latency_p90": percentile(latencies, 90) if latencies else None,
+        "latency_p99": percentile(latencies, 99) if latencies else None,
+        "latency_max": latencies[-1] if latencies else None,
+        "server_cpu_seconds": server_cpu,
+        "server_cpu_ms_per_job": server_cpu * 1000 / max(len(latencies), 1),
+        "db_bytes": db_size,
+    }
+    for failure in failures[:10]:
+        print("Failure:", failure)
+    for key, value in results.items():
+        print(f"{key:<24}{value:>14.4g}" if isinstance(value, float) else f"{key:<24}{value!s:>14}")
+
+    # The settings which affect the results, recorded alongside them.
+    config = {key: value for key, value in vars(args).items() if key not in ("json", "baseline", "keep")}
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            compare(results, json.load(f), config)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({**config, **results}, f, indent=2)
+
+    if failures:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+# Replays the submissions recorded in a queue server's audit log against a local queue server and
+# executors, faster than real time, to see how a fleet of a given size would have coped with real
+# load, such as the rush before a deadline.
+#
+# Each submission in the log is submitted again, as the same user, at its original time relative
+# to the first submission divided by '--speedup'. Jobs run on real executors with the stub 'nvcc'
+# of bench.py, with compile and execution times given in real (unscaled) seconds. Reports each
+# user's queue wait times under the server's least-recently-served scheduling, and the depth of the
+# queue over time. All reported times are scaled back up to real time.
+#
+# Requires the 'openssl' command line tool, like bench.py.
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import bench
+
+# Maximum number of rows of the queue depth table; longer replays are summarized in intervals.
+max_depth_rows = 40
+
+def parse_timestamp(timestamp):
+    parsed = datetime.datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+def load_arrivals(audit_log_path, start, end, max_gap):
+    # Returns [(seconds, username, source)] for each submission in the audit log between 'start'
+    # and 'end', in order, timed from the first one. Gaps between submissions longer than
+    # 'max_gap' seconds, if given, are shortened to it.
+    submissions = []
+    with open(audit_log_path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be partially written if the server is running.
+                continue
+            if entry.get("action") != "submit":
+                continue
+            timestamp = parse_timestamp(entry["timestamp"])
+            if start is not None and timestamp < start:
+                continue
+            if end is not None and timestamp >= end:
+                continue
+            submissions.append((timestamp, entry["username"], entry["request"].get("source", "")))
+    submissions.sort(key=lambda submission: submission[0])
+
+    arrivals = []
+    offset = 0
+    for i, (timestamp, username, source) in enumerate(submissions):
+        if i > 0:
+            gap = (timestamp - submissions[i - 1][0]).total_seconds()
+            if max_gap is not None:
+                gap = min(gap, max_gap)
+            offset += gap
+        arrivals.append((offset, username, source))
+    return arrivals
+
+def replay_job(cluster, submit, username, token, source, speedup, waits, failures):
+    # Submits one job, without overriding the user's pending job, since the audit log does not
+    # record which submissions did. Appends (username, queue wait, turnaround) to 'waits' once it
+    # completes, or (username, None, None) if the server rejected it because the user already had
+    # a pending job, as it may have originally.
+    pool = cluster.connect(submit)
+    started = time.monotonic()
+    try:
+        job_id = submit.submit_job(username, token, source, pool)
+        if job_id is None:
+            waits.append((username, None, None))
+            return
+        result = bench.wait_for_result(submit, pool, username, token, job_id)
+        if result is None:
+            raise RuntimeError(f"Job {job_id} was deleted")
+        turnaround = (time.monotonic() - started) * speedup
+        if not result["success"]:
+            raise RuntimeError(f"Job {job_id} failed: {result}")
+        trace = submit.api_request(pool, "GET", "trace", {"username": username, "token": token, "job_id": job_id})
+    except Exception as e:
+        failures.append(str(e))
+        return
+    # A job which was requeued after its executor lost it waits in the queue more than once.
+    wait_ms = sum(span["end_unix_ms"] - span["start_unix_ms"] for span in trace["spans"] if span["name"] == "queue_wait")
+    waits.append((username, wait_ms / 1000 * speedup, turnaround))
+
+def sample_queue_depth(cluster, submit, interval, speedup, started, samples, stopped):
+    # Appends (seconds, pending, claimed) to 'samples' every 'interval' seconds until 'stopped' is
+    # set, from the server's count of jobs in each state.
+    pool = cluster.connect(submit)
+    admin, token = cluster.admin
+    while True:
+        elapsed = time.monotonic() - started
+        try:
+            response = submit.api_request(pool, "GET", "metrics", {"admin": admin, "token": token})
+        except Exception:
+            response = None
+        if response is not None:
+            counts = response["jobs_by_user"].values()
+            samples.append((
+                elapsed * speedup,
+                sum(count["pending"] for count in counts),
+                sum(count["claimed"] for count in counts),
+            ))
+        if stopped.wait(interval):
+            return
+
+def fairness_index(values):
+    # Jain's fairness index: 1 if all values are equal, down to 1/n if one of n values is non-zero.
+    total_squared = sum(value * value for value in values)
+    if total_squared == 0:
+        return 1.0
+    return sum(values) ** 2 / (len(values) * total_squared)
+
+def summarize_waits(waits):
+    waits = sorted(waits)
+    return {
+        "jobs": len(waits),
+        "wait_mean": sum(waits) / len(waits),
+        "wait_p50": bench.percentile(waits, 50),
+        "wait_p90": bench.percentile(waits, 90),
+        "wait_max": waits[-1],
+    }
+
+def print_queue_depth(samples):
+    # Prints the peak queue depth in each of up to 'max_depth_rows' intervals.
+    if not samples:
+        return
+    per_row = -(-len(samples) // max_depth_rows)
+    print()
+    print(f"{'time':>10}{'pending':>10}{'claimed':>10}")
+    for i in range(0, len(samples), per_row):
+        rows = samples[i:i + per_row]
+        print(f"{rows[0][0]:>9.0f}s{max(row[1] for row in rows):>10}{max(row[2] for row in rows):>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay submissions from an audit log against a local queue server and stub executors")
+    parser.add_argument("audit_log", help="Audit log of the queue server, as written by its --audit-log option")
+    parser.add_argument("--speedup", type=float, default=10, help="How many times faster than real time to replay (default: 10)")
+    parser.add_argument("--start", type=parse_timestamp, help="Only replay submissions from this ISO 8601 time on")
+    parser.add_argument("--end", type=parse_timestamp, help="Only replay submissions before this ISO 8601 time")
+    parser.add_argument("--max-gap", type=float, help="Shorten gaps between submissions to at most this many seconds, to skip idle periods")
+    parser.add_argument("--executors", type=int, default=1, help="Number of executors (default: 1)")
+    parser.add_argument("--nproc-compile", type=int, default=1, help="Compile workers per executor (default: 1)")
+    parser.add_argument("--nproc-execute", type=int, default=1, help="Execution workers per executor (default: 1)")
+    parser.add_argument("--compile-delay", type=float, default=2, help="Seconds each job takes to compile, in real time (default: 2)")
+    parser.add_argument("--execute-delay", type=float, default=1, help="Seconds each job takes to run, in real time (default: 1)")
+    parser.add_argument("--output-size", type=int, default=1024, help="Bytes of output each stub binary prints (default: 1024)")
+    parser.add_argument("--sample-interval", type=float, default=10, help="Seconds between samples of the queue depth, in real time (default: 10)")
+    parser.add_argument("--server-args", default="", help="Extra arguments for the queue server, as one string")
+    parser.add_argument("--executor-args", default="", help="Extra arguments for each executor, as one string")
+    parser.add_argument("--json", help="Write the results, including every queue depth sample, to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary directory, with the database and logs")
+    args = parser.parse_args()
+
+    arrivals = load_arrivals(args.audit_log, args.start, args.end, args.max_gap)
+    if not arrivals:
+        print("No submissions to replay")
+        exit(1)
+    usernames = sorted({username for _, username, _ in arrivals})
+    print(f"Replaying {len(arrivals)} submissions by {len(usernames)} users over {arrivals[-1][0]:.0f}s, in {arrivals[-1][0] / args.speedup:.0f}s")
+
+    submit = bench.load_submit_module()
+    work_dir = tempfile.mkdtemp(prefix="telerun-replay-")
+    bench.write_stub_nvcc(
+        os.path.join(work_dir, "bin"),
+        args.compile_delay / args.speedup,
+        args.execute_delay / args.speedup,
+        args.output_size,
+    )
+
+    cluster = None
+    waits = []
+    failures = []
+    samples = []
+    try:
+        cluster = bench.Cluster(
+            work_dir,
+            len(usernames),
+            args.executors,
+            args.nproc_compile,
+            args.nproc_execute,
+            args.server_args.split(),
+            args.executor_args.split(),
+        )
+        # Each user in the log submits as one of the cluster's users.
+        tokens = {username: cluster.users[i][1] for i, username in enumerate(usernames)}
+        cluster_usernames = {username: cluster.users[i][0] for i, username in enumerate(usernames)}
+
+        started = time.monotonic()
+        stopped = threading.Event()
+        sampler = threading.Thread(
+            target=sample_queue_depth,
+            args=(cluster, submit, args.sample_interval / args.speedup, args.speedup, started, samples, stopped),
+        )
+        sampler.start()
+
+        threads = []
+        for offset, username, source in arrivals:
+            delay = started + offset / args.speedup - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            thread = threading.Thread(
+                target=replay_job,
+                args=(cluster, submit, cluster_usernames[username], tokens[username], source, args.speedup, waits, failures),
+            )
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        stopped.set()
+        sampler.join()
+    finally:
+        if cluster is not None:
+            cluster.stop()
+        if args.keep:
+            print("Kept", work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    # Report by the usernames in the log.
+    original_usernames = {cluster.users[i][0]: username for i, username in enumerate(usernames)}
+    per_user = {}
+    rejected = {}
+    for cluster_username, wait, _ in waits:
+        username = original_usernames[cluster_username]
+        if wait is None:
+            rejected[username] = rejected.get(username, 0) + 1
+        else:
+            per_user.setdefault(username, []).append(wait)
+
+    print()
+    print(f"{'user':<24}{'jobs':>6}{'rejected':>10}{'wait mean':>12}{'p50':>10}{'p90':>10}{'max':>10}")
+    users = {}
+    for username in usernames:
+        if username not in per_user:
+            print(f"{username:<24}{0:>6}{rejected.get(username, 0):>10}")
+            continue
+        summary = {**summarize_waits(per_user[username]), "rejected": rejected.get(username, 0)}
+        users[username] = summary
+        print(
+            f"{username:<24}{summary['jobs']:>6}{summary['rejected']:>10}{summary['wait_mean']:>11.1f}s"
+            f"{summary['wait_p50']:>9.1f}s{summary['wait_p90']:>9.1f}s{summary['wait_max']:>9.1f}s"
+        )
+
+    completed = [wait for _, wait, _ in waits if wait is not None]
+    turnarounds = sorted(turnaround for _, _, turnaround in waits if turnaround is not None)
+    results = {
+        "submissions": len(arrivals),
+        "completed": len(completed),
+        "rejected": sum(rejected.values()),
+        "failures": len(failures),
+        **({f"all_{key}": value for key, value in summarize_waits(completed).items() if key != "jobs"} if completed else {}),
+        "turnaround_p50": bench.percentile(turnarounds, 50) if turnarounds else None,
+        "turnaround_p90": bench.percentile(turnarounds, 90) if turnarounds else None,
+        # How evenly the mean wait is spread across users.
+        "fairness_index": fairness_index([summary["wait_mean"] for summary in users.values()]) if users else None,
+        "peak_pending": max((pending for _, pending, _ in samples), default=0),
+    }
+    print()
+    for failure in failures[:10]:
+        print("Failure:", failure)
+    for key, value in results.items():
+        print(f"{key:<24}{value:>14.4g}" if isinstance(value, float) else f"{key:<24}{value!s:>14}")
+    print_queue_depth(samples)
+
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key not in ("json", "keep")}
+        with open(args.json, "w") as f:
+            json.dump({
+                **config,
+                "start": args.start and args.start.isoformat(),
+                "end": args.end and args.end.isoformat(),
+                **results,
+                "users": users,
+                "queue_depth": [{"seconds": t, "pending": pending, "claimed": claimed} for t, pending, claimed in samples],
+            }, f, indent=2)
+
+    if failures:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
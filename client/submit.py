@@ -1,12 +1,15 @@
 import argparse
 import urllib
 import urllib.parse
-import urllib.request
+import http.client
 import ssl
 import os
 import json
+import gzip
+import zlib
 import traceback
 import time
+import threading
 
 server_cert = """
 -----BEGIN CERTIFICATE-----
@@ -45,25 +48,146 @@ server_ip_port = "35.211.37.232:4443"
 
 poll_interval = 0.25 # seconds
 
-def submit_job(username, token, source, ssl_ctx, override_pending=False):
+# How long the server may hold a status request open while waiting for the job's state to change.
+status_wait = 30 # seconds
+
+# Request bodies at least this large are sent gzip-compressed. Responses are compressed by the
+# server whenever it is worthwhile.
+min_compress_size = 1024 # bytes
+
+# The queue server closes connections which have been idle for 60 seconds. Pooled connections idle
+# for longer than this are not reused, since the server has probably closed them already.
+max_idle_age = 50 # seconds
+
+class ApiError(Exception):
+    def __init__(self, code, response):
+        super().__init__(f"HTTP {code}: {response}")
+        self.code = code
+        self.response = response
+
+class SessionHTTPSConnection(http.client.HTTPSConnection):
+    # An HTTPS connection which resumes the given TLS session when it connects, if possible.
+    def __init__(self, host, context, timeout, session):
+        super().__init__(host, context=context, timeout=timeout)
+        self.tls_session = session
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host, session=self.tls_session)
+
+class ConnectionPool:
+    # A small thread-safe pool of persistent HTTPS connections to the queue server. Connections are
+    # kept alive and reused across requests, and new connections resume the most recent TLS
+    # session, so most requests avoid both the TCP and the TLS handshake.
+    def __init__(self, host, ssl_ctx, max_idle=4):
+        self.host = host
+        self.ssl_ctx = ssl_ctx
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+        self.tls_session = None
+
+    def request(self, method, url, body=None, headers={}, timeout=None):
+        # Returns (status, response body).
+        for attempt in range(2):
+            conn = None
+            with self.lock:
+                while self.idle:
+                    conn, idle_since = self.idle.pop()
+                    if time.monotonic() - idle_since < max_idle_age:
+                        break
+                    conn.close()
+                    conn = None
+            reused = conn is not None
+            if conn is None:
+                conn = SessionHTTPSConnection(self.host, self.ssl_ctx, timeout, self.tls_session)
+            elif conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                response = conn.getresponse()
+                data = decode_body(response.read(), response.getheader("Content-Encoding"))
+            except TimeoutError:
+                conn.close()
+                raise
+            except (http.client.RemoteDisconnected, OSError):
+                conn.close()
+                # The server may close idle connections at any time, which shows up as any of
+                # several errors, such as an SSLEOFError; retry once on a fresh connection.
+                if reused and attempt == 0:
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            if conn.sock is not None:
+                self.tls_session = conn.sock.session
+            if response.will_close:
+                conn.close()
+            else:
+                with self.lock:
+                    if len(self.idle) < self.max_idle:
+                        self.idle.append((conn, time.monotonic()))
+                        conn = None
+                if conn is not None:
+                    conn.close()
+            return response.status, data
+
+def decode_body(data, content_encoding):
+    if content_encoding == "gzip":
+        return gzip.decompress(data)
+    if content_encoding == "deflate":
+        return zlib.decompress(data)
+    return data
+
+def api_request(pool, method, endpoint, query, body=None, timeout=None):
+    url = "/api/" + endpoint + "?" + urllib.parse.urlencode(query)
+    headers = {"Accept-Encoding": "gzip, deflate"}
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+        if len(body) >= min_compress_size:
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+    status, data = pool.request(method, url, body=body, headers=headers, timeout=timeout)
+    response = json.loads(data)
+    if status != 200:
+        raise ApiError(status, response)
+    return response
+
+def submit_job(username, token, source, pool, override_pending=False):
+    # Returns the new job's id, or None if the user already has a pending job and
+    # 'override_pending' is not set.
     query_params = {"username": username, "token": token}
-    if override_pending:
-        query_params["override_pending"] = "1"
-    url_query = urllib.parse.urlencode(query_params)
-    url = "https://" + server_ip_port + "/api/submit?" + url_query
     req_json = json.dumps({"source": source}).encode("utf-8")
-    request = urllib.request.Request(url, data=req_json, method="POST")
-    request.add_header("Content-Type", "application/json")
     try:
-        response = urllib.request.urlopen(request, context=ssl_ctx)
-        response_json = json.load(response)
+        response_json = api_request(pool, "POST", "submit", query_params, body=req_json)
         return response_json["job_id"]
-    except urllib.error.HTTPError as e:
-        if e.code == 400:
-            response_json = json.load(e)
-            if response_json["error"] == "pending_job":
-                return None
-        raise e
+    except ApiError as e:
+        if e.code != 400 or e.response["error"] != "pending_job":
+            raise e
+        if not override_pending:
+            return None
+        # Replace the pending job, naming it, so that it is cancelled even if it has been claimed
+        # in the meantime.
+        query_params["override_pending"] = "1"
+        if e.response.get("job_id") is not None:
+            query_params["replace_job_id"] = e.response["job_id"]
+    response_json = api_request(pool, "POST", "submit", query_params, body=req_json)
+    return response_json["job_id"]
+
+def print_timings(username, token, job_id, pool):
+    # Prints the job's timeline, as recorded by the queue server and the executor.
+    trace = api_request(pool, "GET", "trace", {"username": username, "token": token, "job_id": job_id})
+    submitted_at = trace["submitted_at_unix_ms"]
+    print()
+    print(f"--- Timings (trace {trace['trace_id']}):")
+    print()
+    print(f"{'stage':<16}{'attempt':>8}{'start':>12}{'duration':>12}")
+    for span in trace["spans"]:
+        start = (span["start_unix_ms"] - submitted_at) / 1000
+        duration = (span["end_unix_ms"] - span["start_unix_ms"]) / 1000
+        attempt = span["attempt"] if span["attempt"] is not None else "-"
+        print(f"{span['name']:<16}{attempt:>8}{start:>11.3f}s{duration:>11.3f}s")
 
 def main():
     parser = argparse.ArgumentParser()
@@ -72,7 +196,18 @@ def main():
         "--auth",
         help="Authentication token (defaults to ./auth.json in the same directory as this script)",
     )
+    parser.add_argument(
+        "--server",
+        help=f"Address of the queue server, as host:port (default: {server_ip_port})",
+        default=server_ip_port,
+    )
+    parser.add_argument(
+        "--server-cert",
+        help="File containing the queue server's TLS certificate (default: the certificate of the default server)",
+    )
     parser.add_argument("--override-pending", action="store_true", help="Allow overriding pending jobs")
+    parser.add_argument("--no-live", action="store_true", help="Don't show the job's output until it completes")
+    parser.add_argument("--timings", action="store_true", help="Show how long the job spent in each stage once it completes")
     args = parser.parse_args()
 
     token_path = args.auth or os.path.join(os.path.dirname(__file__), "auth.json")
@@ -83,42 +218,125 @@ def main():
 
     with open(args.file, "r") as f:
         source = f.read()
-    ssl_ctx = ssl.create_default_context(cadata=server_cert)
-    job_id = submit_job(username, token, source, ssl_ctx, override_pending=args.override_pending)
+    cert = server_cert
+    if args.server_cert is not None:
+        with open(args.server_cert, "r") as f:
+            cert = f.read()
+    ssl_ctx = ssl.create_default_context(cadata=cert)
+    pool = ConnectionPool(args.server, ssl_ctx, max_idle=1)
+    job_id = submit_job(username, token, source, pool, override_pending=args.override_pending)
     if job_id is None:
         print("You already have a pending job. Pass '--override-pending' if you want to replace it.")
         exit(1)
     
     print("Submitted job", job_id)
 
-    already_claimed = False
+    state = "pending"
+
+    # The live output printed so far, whether any of it was skipped, and which run of the job it
+    # is from.
+    live_text = []
+    live_offset = 0
+    live_skipped = False
+    live_attempt = None
 
     while True:
-        time.sleep(poll_interval)
         try:
-            url_query = urllib.parse.urlencode({"username": username, "token": token, "job_id": job_id})
-            req = urllib.request.Request(
-                "https://" + server_ip_port + "/api/status?" + url_query,
-                method="GET",
-            )
-            with urllib.request.urlopen(req, context=ssl_ctx) as f:
-                response = json.load(f)
-            
+            prev_state = state
+            if state == "claimed" and not args.no_live:
+                # While the job runs, tail its output.
+                query = {
+                    "username": username,
+                    "token": token,
+                    "job_id": job_id,
+                    "wait": status_wait,
+                    "offset": live_offset,
+                }
+                if live_attempt is not None:
+                    query["attempt"] = live_attempt
+                response = api_request(pool, "GET", "log", query, timeout=status_wait + 30)
+                if live_attempt is not None and response["attempt"] != live_attempt:
+                    # The job was requeued and claimed again, so its live output starts over.
+                    print("\n--- The job was restarted on another executor ---")
+                    live_text = []
+                    live_offset = 0
+                    live_skipped = False
+                    live_attempt = None
+                    state = response["state"]
+                    continue
+                live_attempt = response["attempt"]
+                text = response["text"]
+                if live_offset == 0 and (len(text) > 0 or response["offset"] > 0):
+                    print()
+                    print("--- Live output:")
+                    print()
+                if response["offset"] > live_offset:
+                    print(f"\n--- Skipped {response['offset'] - live_offset} characters of output ---\n")
+                    live_skipped = True
+                print(text, end="", flush=True)
+                live_text.append(text)
+                live_offset = response["offset"] + len(text)
+            else:
+                response = api_request(
+                    pool,
+                    "GET",
+                    "status",
+                    {
+                        "username": username,
+                        "token": token,
+                        "job_id": job_id,
+                        "wait": status_wait,
+                        "state": state,
+                    },
+                    timeout=status_wait + 30,
+                )
+
             state = response["state"]
-            if state == "pending":
+            if state is None:
+                # The job was deleted, for instance by a submission with '--override-pending'.
+                print("Job was cancelled.")
+                exit(1)
+            elif state == "pending":
+                if prev_state == "claimed":
+                    print("The executor running the job stopped responding. Waiting for another one.")
+                    live_text = []
+                    live_offset = 0
+                    live_skipped = False
+                    live_attempt = None
                 continue
             elif state == "claimed":
-                if not already_claimed:
+                if prev_state != "claimed":
                     print("Compiling and running")
-                    already_claimed = True
                 continue
             elif state == "complete":
-                # TODO: Don't double-nest JSON!
-                result = json.loads(response["result"])["result_json"]
+                result = api_request(
+                    pool,
+                    "GET",
+                    "result",
+                    {"username": username, "token": token, "job_id": job_id},
+                )["result"]
+                # If the live output was the start of the logs, which it is unless they were
+                # truncated, finish it off rather than printing the logs again.
+                live_output = "".join(live_text)
+                full_log = result["compile_log"] + result["execute_log"]
+                shown_live = (
+                    len(live_output) > 0 and
+                    not live_skipped and
+                    full_log.startswith(live_output)
+                )
+                if shown_live:
+                    print(full_log[len(live_output):], end="")
+                    live_output = full_log
+                if len(live_output) > 0:
+                    if not live_output.endswith("\n"):
+                        print()
+                    print()
                 if result["success"]:
                     print("Job completed successfully.")
                 else:
                     print("Job failed.")
+                if shown_live:
+                    break
                 print()
                 print("--- Compilation log:")
                 print()
@@ -128,9 +346,25 @@ def main():
                 print()
                 print(result["execute_log"])
                 break
+        except KeyboardInterrupt:
+            # Cancel the job, so that it stops running on the executor.
+            print()
+            try:
+                api_request(pool, "POST", "delete", {"username": username, "token": token, "job_id": job_id})
+                print("Cancelled job", job_id)
+            except Exception as e:
+                print("Failed to cancel job", job_id)
+            exit(1)
         except Exception as e:
             traceback.print_exc()
+            time.sleep(poll_interval)
             continue
 
+    if args.timings:
+        try:
+            print_timings(username, token, job_id, pool)
+        except Exception as e:
+            traceback.print_exc()
+
 if __name__ == "__main__":
     main()
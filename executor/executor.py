@@ -1,18 +1,29 @@
 import urllib
 import urllib.parse
-import urllib.request
+import http.client
 import ssl
 import os
 import json
+import gzip
+import zlib
 import time
 import traceback
 import multiprocessing
 import subprocess
-from dataclasses import dataclass
-from typing import Optional
+import select
+import signal
+from dataclasses import dataclass, field
+from typing import Callable, Optional
 import argparse
 import uuid
 import shutil
+import threading
+import queue
+import hashlib
+import codecs
+import tempfile
+import bisect
+import http.server
 
 server_cert = """
 -----BEGIN CERTIFICATE-----
@@ -51,32 +62,652 @@ server_ip_port = "35.211.37.232:4443"
 
 poll_interval = 0.25 # seconds
 
+# How long the server may hold a claim request open while waiting for a job to arrive.
+claim_wait = 30 # seconds
+
+# Upper bound on how many jobs a single claim request may claim (matching the queue server's).
+max_claim_batch = 64
+
 compile_timeout = 60 # seconds
 execute_timeout = 60 # seconds
 
+# Only the first and last 'max_log_length / 2' bytes of each compile and execute log are kept.
 max_log_length = 1 << 20
 
 compute_capability = "86"
 
+nvcc_flags = [
+    "-O3",
+    "-use_fast_math",
+    f"-arch=compute_{compute_capability}",
+    f"-code=sm_{compute_capability}",
+]
+
+# How many jobs per execution worker may be claimed ahead of time, to be compiled while the
+# execution workers are busy. Jobs are only claimed when there is room for them in the pipeline,
+# so that jobs never sit idle on the executor when they could be claimed by another one.
+compile_ahead = 1
+
+# With --pin-cpus, each execution worker (and the job it runs) gets this many cores of its own,
+# local to its GPU where possible, and the compile workers share the remaining cores.
+execute_cpus = 2
+
+# Directories of executors which did not record their process ID are only swept away as orphans
+# once they have not been modified for this long, in case their executor is still starting up.
+orphan_grace_period = 60 # seconds
+
+# Upper bounds of the buckets of the stage time histograms.
+metrics_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60] # seconds
+
+# A summary of stage times over the last interval is printed this often.
+metrics_log_interval = 60 # seconds
+
+# Size limit for the on-disk cache of compiled binaries.
+compile_cache_size = 2048 # MiB
+
+# Completed jobs are uploaded by this many concurrent uploader threads, each of which sends up to
+# 'max_upload_batch' results per request, and at most 'max_upload_size' bytes of them before
+# compression (the queue server's limit). A single result, with two logs of at most
+# 'max_log_length', always fits even when its logs are escaped in JSON.
+upload_concurrency = 4
+max_upload_batch = 16
+max_upload_size = 1 << 26 # 64 MB
+
+# Failed uploads are retried after 'upload_retry_interval' seconds, doubling after each failure up
+# to 'max_upload_retry_interval'. The jobs' leases are renewed in the meantime.
+upload_retry_interval = 1 # seconds
+max_upload_retry_interval = 30 # seconds
+
+# The executor reports the jobs it is working on to the queue server every 'heartbeat_interval'
+# seconds, which renews its leases on them, and stops any which have been cancelled. The server
+# requeues jobs whose leases are not renewed for several seconds. Running processes check for cancellation every
+# 'cancel_poll_interval' seconds.
+heartbeat_interval = 1 # seconds
+cancel_poll_interval = 0.25 # seconds
+
+# Heartbeats, uploads and live log uploads give up after half of the queue server's default lease
+# duration, so that a stalled connection is abandoned and the request retried on a fresh one before
+# the leases run out.
+lease_request_timeout = 5 # seconds
+
+# Output of running jobs is streamed to the queue server as it is produced, for clients to tail.
+# Chunks of output are collected for up to 'log_flush_interval' seconds and sent in one request.
+log_flush_interval = 0.5 # seconds
+
+# Request bodies at least this large are sent gzip-compressed. Responses are compressed by the
+# server whenever it is worthwhile.
+min_compress_size = 1024 # bytes
+
+# The queue server closes connections which have been idle for 60 seconds. Pooled connections idle
+# for longer than this are not reused, since the server has probably closed them already.
+max_idle_age = 50 # seconds
+
+class ApiError(Exception):
+    def __init__(self, code, response):
+        super().__init__(f"HTTP {code}: {response}")
+        self.code = code
+        self.response = response
+
+class SessionHTTPSConnection(http.client.HTTPSConnection):
+    # An HTTPS connection which resumes the given TLS session when it connects, if possible.
+    def __init__(self, host, context, timeout, session):
+        super().__init__(host, context=context, timeout=timeout)
+        self.tls_session = session
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host, session=self.tls_session)
+
+class ConnectionPool:
+    # A small thread-safe pool of persistent HTTPS connections to the queue server. Connections are
+    # kept alive and reused across requests, and new connections resume the most recent TLS
+    # session, so most requests avoid both the TCP and the TLS handshake.
+    def __init__(self, host, ssl_ctx, max_idle=4):
+        self.host = host
+        self.ssl_ctx = ssl_ctx
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+        self.tls_session = None
+
+    def request(self, method, url, body=None, headers={}, timeout=None):
+        # Returns (status, response body).
+        for attempt in range(2):
+            conn = None
+            with self.lock:
+                while self.idle:
+                    conn, idle_since = self.idle.pop()
+                    if time.monotonic() - idle_since < max_idle_age:
+                        break
+                    conn.close()
+                    conn = None
+            reused = conn is not None
+            if conn is None:
+                conn = SessionHTTPSConnection(self.host, self.ssl_ctx, timeout, self.tls_session)
+            elif conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                response = conn.getresponse()
+                data = decode_body(response.read(), response.getheader("Content-Encoding"))
+            except TimeoutError:
+                conn.close()
+                raise
+            except (http.client.RemoteDisconnected, OSError):
+                conn.close()
+                # The server may close idle connections at any time, which shows up as any of
+                # several errors, such as an SSLEOFError; retry once on a fresh connection.
+                if reused and attempt == 0:
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            if conn.sock is not None:
+                self.tls_session = conn.sock.session
+            if response.will_close:
+                conn.close()
+            else:
+                with self.lock:
+                    if len(self.idle) < self.max_idle:
+                        self.idle.append((conn, time.monotonic()))
+                        conn = None
+                if conn is not None:
+                    conn.close()
+            return response.status, data
+
+def decode_body(data, content_encoding):
+    if content_encoding == "gzip":
+        return gzip.decompress(data)
+    if content_encoding == "deflate":
+        return zlib.decompress(data)
+    return data
+
+def api_request(pool, method, endpoint, query, body=None, timeout=None):
+    url = "/api/" + endpoint + "?" + urllib.parse.urlencode(query)
+    headers = {"Accept-Encoding": "gzip, deflate"}
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+        if len(body) >= min_compress_size:
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+    status, data = pool.request(method, url, body=body, headers=headers, timeout=timeout)
+    response = json.loads(data)
+    if status != 200:
+        raise ApiError(status, response)
+    return response
+
 @dataclass
 class CompileJob:
     job_id: int
+    # Which claim of the job this is; a job is claimed again if a previous claim's lease ran out.
+    attempt: int
     job_dir: str
     source: str
+    # Times (from time.time()) at which the job reached each stage of the pipeline so far.
+    timestamps: dict = field(default_factory=dict)
+    # Identifies the job's timeline on the queue server.
+    trace_id: Optional[str] = None
 
 @dataclass
 class ExecuteJob:
     job_id: int
+    attempt: int
     job_dir: str
     compile_log: str
+    # Length of the job's live log so far, which the execution output continues.
+    live_log_offset: int = 0
+    timestamps: dict = field(default_factory=dict)
+    trace_id: Optional[str] = None
 
 @dataclass
 class CompleteJob:
     job_id: int
+    attempt: int
     job_dir: str
     success: bool
     compile_log: str
     execute_log: Optional[str] = None
+    # Whether nvcc ran to completion and rejected the source, as opposed to timing out or failing
+    # for some other reason. The queue server caches such failures.
+    compile_failed: bool = False
+    # Whether the job was cancelled, in which case there is no result to upload.
+    cancelled: bool = False
+    timestamps: dict = field(default_factory=dict)
+    trace_id: Optional[str] = None
+
+    def __post_init__(self):
+        self.timestamps["completed"] = time.time()
+
+class BoundedOutput:
+    # Accumulates a process's output, keeping only its first and last 'max_bytes / 2' bytes, so
+    # that a program which prints in a loop cannot use an unbounded amount of memory.
+    def __init__(self, max_bytes: int):
+        self.head_limit = max_bytes // 2
+        self.tail_limit = max_bytes - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total_bytes = 0
+
+    def write(self, data: bytes) -> bytes:
+        # Returns the part of 'data' which was kept in the head.
+        self.total_bytes += len(data)
+        head_data = b""
+        if len(self.head) < self.head_limit:
+            n = self.head_limit - len(self.head)
+            head_data = data[:n]
+            self.head += head_data
+            data = data[n:]
+        self.tail += data
+        # Let the tail grow to twice its limit before trimming it, so that trimming (which moves
+        # the whole buffer) happens only once per 'tail_limit' bytes written.
+        if len(self.tail) > 2 * self.tail_limit:
+            del self.tail[:-self.tail_limit]
+        return head_data
+
+    def text(self) -> str:
+        tail = self.tail[-self.tail_limit:] if self.tail_limit > 0 else b""
+        dropped_bytes = self.total_bytes - len(self.head) - len(tail)
+        # Output is not necessarily valid UTF-8, and may have been cut in the middle of a character.
+        text = self.head.decode("utf-8", errors="replace")
+        if dropped_bytes > 0:
+            text += f"\n--- truncated {dropped_bytes} bytes... ---\n"
+        return text + tail.decode("utf-8", errors="replace")
+
+class LiveLog:
+    # Streams a job's output to the queue server while the job runs, by way of the complete
+    # worker's log uploader. Only the head of each log is streamed, so that when a log is not
+    # truncated, the live log is exactly the compile log followed by the execute log.
+    def __init__(self, log_queue, job_id: int, attempt: int, offset: int = 0):
+        self.log_queue = log_queue
+        self.job_id = job_id
+        self.attempt = attempt
+        self.offset = offset
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def write(self, text: str):
+        if len(text) > 0:
+            self.log_queue.put((self.job_id, self.attempt, self.offset, text))
+            self.offset += len(text)
+
+    def write_bytes(self, data: bytes):
+        self.write(self.decoder.decode(data))
+
+    def finish(self):
+        self.write(self.decoder.decode(b"", final=True))
+
+@dataclass
+class CapturedOutput:
+    returncode: Optional[int]
+    output: str
+    timed_out: bool
+    cancelled: bool = False
+
+def run_captured(args, timeout: float, live_log: Optional[LiveLog] = None, is_cancelled: Optional[Callable[[], bool]] = None, **kwargs) -> CapturedOutput:
+    # Runs a command with stderr merged into stdout, streaming its output into a 'BoundedOutput',
+    # and the head of its output into 'live_log', if given.
+    # The command runs in its own process group, so that on timeout, or once 'is_cancelled'
+    # returns True, it is killed along with any processes it has spawned. The output captured up
+    # to that point is still returned.
+    deadline = time.monotonic() + timeout
+    next_cancel_check = time.monotonic() if is_cancelled is not None else float("inf")
+    output = BoundedOutput(max_log_length)
+    proc = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+        **kwargs,
+    )
+    timed_out = False
+    cancelled = False
+    try:
+        fd = proc.stdout.fileno()
+        output_closed = False
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                timed_out = True
+                break
+            if now >= next_cancel_check:
+                if is_cancelled():
+                    cancelled = True
+                    break
+                next_cancel_check = now + cancel_poll_interval
+            wait = min(deadline, next_cancel_check) - now
+            if output_closed:
+                # The command has closed its output, but may still be running.
+                try:
+                    proc.wait(wait)
+                    break
+                except subprocess.TimeoutExpired:
+                    continue
+            readable, _, _ = select.select([fd], [], [], wait)
+            if readable:
+                data = os.read(fd, 1 << 16)
+                if not data:
+                    output_closed = True
+                    continue
+                head_data = output.write(data)
+                if live_log is not None and len(head_data) > 0:
+                    live_log.write_bytes(head_data)
+    finally:
+        if timed_out or cancelled or proc.returncode is None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            proc.wait()
+        proc.stdout.close()
+        if live_log is not None:
+            live_log.finish()
+    returncode = None if timed_out or cancelled else proc.returncode
+    return CapturedOutput(returncode, output.text(), timed_out, cancelled)
+
+class Credits:
+    # A budget of jobs allowed in some part of the executor's pipeline at once, shared between
+    # processes. The claim worker takes credits before claiming jobs, so that it never claims more
+    # jobs than there is room for, and workers give them back as jobs leave that part of the
+    # pipeline.
+    def __init__(self, limit: int):
+        self.semaphore = multiprocessing.BoundedSemaphore(limit)
+
+    def take(self, max_credits: int) -> int:
+        # Waits until at least one credit is free, then takes up to 'max_credits' of the free
+        # credits, and returns how many were taken.
+        self.semaphore.acquire()
+        taken = 1
+        while taken < max_credits and self.semaphore.acquire(block=False):
+            taken += 1
+        return taken
+
+    def give_back(self, credits: int = 1):
+        for _ in range(credits):
+            self.semaphore.release()
+
+class StageMetrics:
+    # Histograms of how long jobs spend in each stage of the pipeline, shared between processes:
+    #
+    #   claim         round trip of a claim request
+    #   compile_wait  from being claimed until a compile worker starts on the job
+    #   compile       compilation, including compile cache lookups
+    #   execute_wait  from being compiled until an execution worker starts on the job
+    #   execute       running the job
+    #   upload_wait   from finishing until an upload of the result starts
+    #   upload        round trip of the upload request
+    #   cleanup       emptying the job's workspace for reuse
+    #   total         from being claimed until the result is uploaded
+    stages = ["claim", "compile_wait", "compile", "execute_wait", "execute", "upload_wait", "upload", "cleanup", "total"]
+
+    def __init__(self):
+        # For each stage, the number of observations in each bucket (the last one unbounded),
+        # followed by the total number of observations and their sum.
+        self.width = len(metrics_buckets) + 3
+        self.values = multiprocessing.Array("d", len(self.stages) * self.width)
+
+    def observe(self, stage: str, seconds: float):
+        row = self.stages.index(stage) * self.width
+        bucket = bisect.bisect_left(metrics_buckets, seconds)
+        with self.values.get_lock():
+            self.values[row + bucket] += 1
+            self.values[row + self.width - 2] += 1
+            self.values[row + self.width - 1] += seconds
+
+    def snapshot(self) -> dict:
+        # Returns {stage: (bucket_counts, count, sum)}.
+        with self.values.get_lock():
+            values = self.values[:]
+        snapshot = {}
+        for i, stage in enumerate(self.stages):
+            row = values[i * self.width:(i + 1) * self.width]
+            snapshot[stage] = (row[:-2], row[-2], row[-1])
+        return snapshot
+
+    def prometheus_text(self) -> str:
+        lines = [
+            "# HELP telerun_executor_stage_seconds Time jobs spend in each stage of the executor pipeline.",
+            "# TYPE telerun_executor_stage_seconds histogram",
+        ]
+        for stage, (buckets, count, total) in self.snapshot().items():
+            cumulative = 0
+            for le, n in zip(metrics_buckets + ["+Inf"], buckets):
+                cumulative += n
+                lines.append(f'telerun_executor_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {int(cumulative)}')
+            lines.append(f'telerun_executor_stage_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'telerun_executor_stage_seconds_count{{stage="{stage}"}} {int(count)}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self, previous: dict, current: dict) -> str:
+        # Summarizes the observations between two snapshots, with the mean and the bucket bound of
+        # the 90th percentile of each stage.
+        parts = []
+        for stage in self.stages:
+            buckets = [n - m for n, m in zip(current[stage][0], previous[stage][0])]
+            count = current[stage][1] - previous[stage][1]
+            if count == 0:
+                continue
+            mean = (current[stage][2] - previous[stage][2]) / count
+            cumulative = 0
+            for le, n in zip(metrics_buckets + [float("inf")], buckets):
+                cumulative += n
+                if cumulative >= 0.9 * count:
+                    break
+            parts.append(f"{stage} n={int(count)} mean={mean:.3f}s p90<={le}s")
+        return ", ".join(parts) if parts else "no jobs"
+
+def metrics_log_worker(metrics: StageMetrics, interval: float):
+    previous = metrics.snapshot()
+    while True:
+        time.sleep(interval)
+        current = metrics.snapshot()
+        print(f"Stage times over the last {interval:g}s: {metrics.summary(previous, current)}")
+        previous = current
+
+def serve_metrics(metrics: StageMetrics, port: int):
+    # Serves the stage time histograms in the Prometheus text format, on localhost only.
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.serve_forever()
+
+def parse_cpu_list(text: str) -> list:
+    # Parses a Linux CPU list, such as "0-3,8,10-11".
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+def load_topology(path: str) -> dict:
+    # Reads a topology map of the form
+    #
+    #   {"numa_nodes": {"0": [0, 1, 2, 3], "1": [4, 5, 6, 7]}, "gpus": [0, 1]}
+    #
+    # which lists the cores of each NUMA node, and the NUMA node of each GPU (by CUDA index), or
+    # null if it is unknown. Cores may also be given as CPU list strings such as "0-3".
+    with open(path, "r") as f:
+        topology = json.load(f)
+    return {
+        "numa_nodes": {
+            int(node): parse_cpu_list(cpus) if isinstance(cpus, str) else [int(cpu) for cpu in cpus]
+            for node, cpus in topology["numa_nodes"].items()
+        },
+        "gpus": [None if node is None else int(node) for node in topology.get("gpus", [])],
+    }
+
+def detect_topology() -> dict:
+    # Builds the topology map of this machine from sysfs and nvidia-smi, in the same form as
+    # 'load_topology'. Missing information is left out, rather than treated as an error.
+    numa_nodes = {}
+    node_dir = "/sys/devices/system/node"
+    try:
+        node_names = os.listdir(node_dir)
+    except OSError:
+        node_names = []
+    for name in node_names:
+        if not (name.startswith("node") and name[4:].isdigit()):
+            continue
+        try:
+            with open(os.path.join(node_dir, name, "cpulist"), "r") as f:
+                numa_nodes[int(name[4:])] = parse_cpu_list(f.read())
+        except OSError:
+            continue
+    if not numa_nodes:
+        numa_nodes[0] = sorted(os.sched_getaffinity(0))
+
+    gpus = []
+    try:
+        out = subprocess.run(
+            ["nvidia-smi", "--query-gpu=pci.bus_id", "--format=csv,noheader"],
+            timeout=30,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        bus_ids = out.stdout.split() if out.returncode == 0 else []
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"Could not list GPUs with nvidia-smi: {e}")
+        bus_ids = []
+    for bus_id in bus_ids:
+        # nvidia-smi reports e.g. "00000000:3B:00.0", while sysfs uses "0000:3b:00.0".
+        domain, _, rest = bus_id.lower().partition(":")
+        try:
+            with open(f"/sys/bus/pci/devices/{domain[-4:]}:{rest}/numa_node", "r") as f:
+                node = int(f.read())
+        except (OSError, ValueError):
+            node = -1
+        gpus.append(node if node in numa_nodes else None)
+    return {"numa_nodes": numa_nodes, "gpus": gpus}
+
+def assign_cpus(topology: dict, allowed_cpus: set, nproc_execute: int, cpus_per_worker: int):
+    # Returns (execute_cpus, compile_cpus): a list of the cores for each execution worker, taken
+    # from the NUMA node of its GPU where possible, and the remaining cores, for the compile
+    # workers. Only cores in 'allowed_cpus' are assigned. None means a worker is left unpinned,
+    # because there are not enough cores to give it any of its own.
+    free = [cpu for node in sorted(topology["numa_nodes"]) for cpu in topology["numa_nodes"][node] if cpu in allowed_cpus]
+    execute_cpus = []
+    for gpu_index in range(nproc_execute):
+        gpus = topology["gpus"]
+        node = gpus[gpu_index] if gpu_index < len(gpus) else None
+        # A GPU whose NUMA node is unknown (None, or -1 as reported by sysfs) has no local cores,
+        # so it is given any free cores.
+        known_node = node in topology["numa_nodes"]
+        local = set(topology["numa_nodes"][node]) if known_node else set()
+        # Prefer cores local to the GPU, then fall back to any free cores.
+        candidates = [cpu for cpu in free if cpu in local] + [cpu for cpu in free if cpu not in local]
+        cpus = candidates[:cpus_per_worker]
+        # Always leave at least one core for the compile workers.
+        if len(cpus) < cpus_per_worker or len(free) - len(cpus) < 1:
+            print(f"Not enough cores to pin execution worker {gpu_index}; leaving it unpinned")
+            execute_cpus.append(None)
+            continue
+        if known_node and not set(cpus) <= local:
+            print(f"Not enough cores local to GPU {gpu_index}; using cores from other NUMA nodes")
+        free = [cpu for cpu in free if cpu not in cpus]
+        execute_cpus.append(cpus)
+    return execute_cpus, free or None
+
+def pin_cpus(cpus: Optional[list]):
+    # Confines this process, and the processes it starts, to the given cores.
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+
+class Workspaces:
+    # Pool of job directories under this executor's workspace root, shared between processes. Jobs
+    # take an empty directory from the pool when they are claimed, and give it back once their
+    # results have been uploaded. Directories are emptied by 'cleanup_worker' before they are
+    # reused, so that filesystem work stays off the path of the results.
+
+    def __init__(self, root: str, pool_size: int):
+        self.root = root
+        self.free = multiprocessing.Queue()
+        self.dirty = multiprocessing.Queue()
+        for _ in range(pool_size):
+            self.free.put(self.create())
+
+    def create(self) -> str:
+        return tempfile.mkdtemp(prefix="job-", dir=self.root)
+
+    def take(self) -> str:
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            return self.create()
+
+    def give_back(self, job_dir: str):
+        self.dirty.put(job_dir)
+
+    def cleanup_worker(self, metrics: StageMetrics):
+        while True:
+            job_dir = self.dirty.get()
+            started = time.time()
+            try:
+                for entry in os.scandir(job_dir):
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.unlink(entry.path)
+            except OSError as e:
+                # Don't reuse a directory which could not be emptied.
+                traceback.print_exc()
+                shutil.rmtree(job_dir, ignore_errors=True)
+                continue
+            metrics.observe("cleanup", time.time() - started)
+            self.free.put(job_dir)
+
+def create_executor_dir(parent_dir: str) -> str:
+    # Creates this executor's directory under 'parent_dir', recording the executor's process ID in
+    # it, so that other executors can tell whether it has been orphaned.
+    executor_dir = os.path.join(parent_dir, f"executor-{uuid.uuid4()}")
+    os.makedirs(executor_dir)
+    with open(os.path.join(executor_dir, "pid"), "w") as f:
+        f.write(str(os.getpid()))
+    return executor_dir
+
+def is_orphaned(executor_dir: str) -> bool:
+    try:
+        with open(os.path.join(executor_dir, "pid"), "r") as f:
+            pid = int(f.read())
+    except (OSError, ValueError):
+        try:
+            return os.stat(executor_dir).st_mtime < time.time() - orphan_grace_period
+        except OSError:
+            return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+def sweep_orphaned_dirs(parent_dirs: list):
+    # Removes the directories left behind by executors which are no longer running.
+    for parent_dir in parent_dirs:
+        try:
+            names = os.listdir(parent_dir)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(parent_dir, name)
+            if name.startswith("executor-") and os.path.isdir(path) and is_orphaned(path):
+                print("Removing orphaned executor directory", path)
+                shutil.rmtree(path, ignore_errors=True)
 
 def src_path(job_dir: str) -> str:
     return os.path.join(job_dir, "src.cu")
@@ -84,148 +715,522 @@ def src_path(job_dir: str) -> str:
 def bin_path(job_dir: str) -> str:
     return os.path.join(job_dir, "bin")
 
-def claim_worker(compile_queue, auth, scratch_dir: str):
-    ssl_ctx = ssl.create_default_context(cadata=server_cert)
+def claim_worker(compile_queue, job_credits: Credits, compile_credits: Credits, in_flight, server: str, cert: str, auth, workspaces: Workspaces, metrics: StageMetrics):
+    ssl_ctx = ssl.create_default_context(cadata=cert)
+    pool = ConnectionPool(server, ssl_ctx, max_idle=1)
     
     auth_name = auth["executor"]
     auth_token = auth["token"]
 
     while True:
-        time.sleep(poll_interval)
+        # Wait until there is room in the pipeline for at least one more job, and a compile worker
+        # is free to start on it, then claim as many jobs as there is room for in a single request.
+        free_slots = job_credits.take(max_claim_batch)
+        free_compile_slots = compile_credits.take(free_slots)
+        job_credits.give_back(free_slots - free_compile_slots)
+        free_slots = free_compile_slots
+        claimed = 0
         try:
-            url_query = urllib.parse.urlencode({"executor": auth_name, "token": auth_token})
-
-            req = urllib.request.Request(
-                "https://" + server_ip_port + "/api/claim?" + url_query,
-                method="POST",
+            response = api_request(
+                pool,
+                "POST",
+                "claim",
+                {
+                    "executor": auth_name,
+                    "token": auth_token,
+                    "wait": claim_wait,
+                    "max": free_slots,
+                },
+                timeout=claim_wait + 30,
             )
-            with urllib.request.urlopen(req, context=ssl_ctx) as f:
-                response = json.load(f)
             
             assert response["success"]
+            claimed_at = time.time()
 
-            job_id = response["job_id"]
-            if job_id is None:
-                continue
-            print("Claimed job", job_id)
+            for job in response["jobs"]:
+                job_id = job["job_id"]
+                attempt = job["attempt"]
+                print("Claimed job", job_id)
+
+                # The claim takes from when the server claimed the job until its response arrives,
+                # leaving out the time the request was held open waiting for a job. Servers which
+                # don't report when they claimed jobs are left out of the claim times and spans.
+                timestamps = {"claimed": claimed_at}
+                if "claimed_at_unix_ms" in job:
+                    # The server's clock may be slightly ahead of this executor's.
+                    timestamps["claim_started"] = min(job["claimed_at_unix_ms"] / 1000, claimed_at)
+                    metrics.observe("claim", claimed_at - timestamps["claim_started"])
 
-            source = response["request_json"]["source"]
+                source = job["request_json"]["source"]
 
-            job_dir = os.path.join(scratch_dir, str(f"job-{job_id}"))
+                job_dir = workspaces.take()
 
-            compile_queue.put(CompileJob(job_id, job_dir, source))
+                in_flight[(job_id, attempt)] = False
+                compile_queue.put(CompileJob(
+                    job_id,
+                    attempt,
+                    job_dir,
+                    source,
+                    timestamps,
+                    job.get("trace_id"),
+                ))
+                claimed += 1
         except Exception as e:
             traceback.print_exc()
+            time.sleep(poll_interval)
             continue
+        finally:
+            job_credits.give_back(free_slots - claimed)
+            compile_credits.give_back(free_slots - claimed)
+
+class CompileCache:
+    # On-disk cache of compiled binaries and their compile logs, keyed by a hash of the source, the
+    # nvcc version and the compiler flags. The cache directory may be shared by any number of
+    # processes: entries are built in a temporary directory and atomically renamed into place, and
+    # are evicted (least recently used first) by atomically renaming them out of place, so a
+    # reader always sees either a complete entry or none at all.
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, source: str, nvcc_version: str) -> str:
+        key_data = json.dumps([source, nvcc_version, nvcc_flags])
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    def lookup(self, key: str, dest_bin_path: str) -> Optional[str]:
+        # On a hit, copies the cached binary to 'dest_bin_path' and returns the compile log.
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            # Binaries are copied rather than linked, so that a running program cannot modify the
+            # cached copy.
+            shutil.copy2(bin_path(entry), dest_bin_path)
+            with open(os.path.join(entry, "log"), "r") as f:
+                log = f.read()
+            os.utime(entry)
+            return log
+        except FileNotFoundError:
+            return None
+
+    def insert(self, key: str, src_bin_path: str, log: str):
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        try:
+            shutil.copy2(src_bin_path, bin_path(tmp_dir))
+            with open(os.path.join(tmp_dir, "log"), "w") as f:
+                f.write(log)
+            os.rename(tmp_dir, os.path.join(self.cache_dir, key))
+        except OSError:
+            # Most likely another process inserted the same entry first.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total_bytes = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if name.startswith(".tmp-"):
+                    # Remove temporary directories left behind by crashed processes.
+                    if os.stat(path).st_mtime < time.time() - 3600:
+                        shutil.rmtree(path, ignore_errors=True)
+                    continue
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((os.stat(path).st_mtime, size, path))
+                total_bytes += size
+            except FileNotFoundError:
+                continue
+        entries.sort()
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            evicted_path = os.path.join(self.cache_dir, ".tmp-evicted-" + uuid.uuid4().hex)
+            try:
+                os.rename(path, evicted_path)
+            except FileNotFoundError:
+                continue
+            shutil.rmtree(evicted_path, ignore_errors=True)
+            total_bytes -= size
+
+def get_nvcc_version() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["nvcc", "--version"],
+            timeout=compile_timeout,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+    except Exception as e:
+        traceback.print_exc()
+        return None
+    if out.returncode != 0:
+        return None
+    return out.stdout
+
+def toolchain_id(nvcc_version: Optional[str]) -> Optional[str]:
+    # Identifies the compiler and flags which sources are compiled with, so that the queue server
+    # only reuses a compile failure while executors still compile the same way.
+    if nvcc_version is None:
+        return None
+    return hashlib.sha256(json.dumps([nvcc_version, nvcc_flags]).encode("utf-8")).hexdigest()
+
+def compile_worker(compile_queue, job_credits: Credits, compile_credits: Credits, complete_queue, execute_queue, log_queue, in_flight, cache_dir: Optional[str], cache_bytes: int, cpus: Optional[list], metrics: StageMetrics):
+    pin_cpus(cpus)
+    cache = None
+    nvcc_version = None
+    if cache_dir is not None and cache_bytes > 0:
+        nvcc_version = get_nvcc_version()
+        if nvcc_version is not None:
+            cache = CompileCache(cache_dir, cache_bytes)
 
-def compile_worker(compile_queue, complete_queue, execute_queue):
     while True:
         compile_job: CompileJob = compile_queue.get()
-        put_fail = (
-            lambda log: complete_queue.put(
-                CompleteJob(compile_job.job_id, compile_job.job_dir, False, log, None)
-            )
-        )
+        started = time.time()
+        compile_job.timestamps["compile_started"] = started
+        metrics.observe("compile_wait", started - compile_job.timestamps["claimed"])
+        queued_for_execution = False
         try:
-            os.makedirs(compile_job.job_dir, exist_ok=True)
-            with open(src_path(compile_job.job_dir), "w") as f:
-                f.write(compile_job.source)
-            out = subprocess.run(
-                [
-                    "nvcc",
-                    "-O3",
-                    "-use_fast_math",
-                    f"-arch=compute_{compute_capability}",
-                    f"-code=sm_{compute_capability}",
-                    "-o", bin_path(compile_job.job_dir),
-                    src_path(compile_job.job_dir),
-                ],
-                timeout=compile_timeout,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-            )
-            if out.returncode == 0:
-                execute_queue.put(ExecuteJob(compile_job.job_id, compile_job.job_dir, out.stdout))
-            else:
-                put_fail(out.stdout)
-        except subprocess.TimeoutExpired:
+            queued_for_execution = run_compile(compile_job, complete_queue, execute_queue, log_queue, in_flight, cache, nvcc_version)
+        finally:
+            metrics.observe("compile", compile_job.timestamps.get("compiled", time.time()) - started)
+            compile_credits.give_back()
+            # Jobs which will not be executed leave the pipeline here.
+            if not queued_for_execution:
+                job_credits.give_back()
+
+def put_cancelled(complete_queue, job):
+    print("Cancelled job", job.job_id)
+    complete_queue.put(CompleteJob(job.job_id, job.attempt, job.job_dir, False, "", None, cancelled=True, timestamps=job.timestamps, trace_id=job.trace_id))
+
+def run_compile(compile_job: CompileJob, complete_queue, execute_queue, log_queue, in_flight, cache: Optional[CompileCache], nvcc_version: Optional[str]) -> bool:
+    # Returns whether the job was queued for execution.
+    live_log = LiveLog(log_queue, compile_job.job_id, compile_job.attempt)
+    # 'in_flight' maps the (job_id, attempt) pairs of the jobs this executor is working on to
+    # whether they have been cancelled.
+    is_cancelled = lambda: in_flight.get((compile_job.job_id, compile_job.attempt), False)
+    put_fail = (
+        lambda log: complete_queue.put(
+            CompleteJob(compile_job.job_id, compile_job.attempt, compile_job.job_dir, False, log, None, timestamps=compile_job.timestamps, trace_id=compile_job.trace_id)
+        )
+    )
+    if is_cancelled():
+        put_cancelled(complete_queue, compile_job)
+        return False
+    try:
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.key(compile_job.source, nvcc_version)
+            cached_log = cache.lookup(cache_key, bin_path(compile_job.job_dir))
+            if cached_log is not None:
+                print("Compile cache hit for job", compile_job.job_id)
+                live_log.write(cached_log)
+                compile_job.timestamps["compiled"] = time.time()
+                execute_queue.put(ExecuteJob(compile_job.job_id, compile_job.attempt, compile_job.job_dir, cached_log, live_log.offset, compile_job.timestamps, compile_job.trace_id))
+                return True
+
+        with open(src_path(compile_job.job_dir), "w") as f:
+            f.write(compile_job.source)
+        out = run_captured(
+            [
+                "nvcc",
+                *nvcc_flags,
+                "-o", bin_path(compile_job.job_dir),
+                src_path(compile_job.job_dir),
+            ],
+            timeout=compile_timeout,
+            live_log=live_log,
+            is_cancelled=is_cancelled,
+            # Keep nvcc's intermediate files in the job's workspace, which may be on a tmpfs.
+            env={**os.environ, "TMPDIR": compile_job.job_dir},
+        )
+        if out.cancelled:
+            put_cancelled(complete_queue, compile_job)
+        elif out.timed_out:
             put_fail(
-                f"Compilation timed out after {compile_timeout} seconds. Output log:\n\n" + out.stdout
+                f"Compilation timed out after {compile_timeout} seconds. Output log:\n\n" + out.output
             )
-        except Exception as e:
-            put_fail("Compilation failed with exception:\n" + str(e))
+        elif out.returncode == 0:
+            if cache_key is not None:
+                try:
+                    cache.insert(cache_key, bin_path(compile_job.job_dir), out.output)
+                except Exception as e:
+                    traceback.print_exc()
+            compile_job.timestamps["compiled"] = time.time()
+            execute_queue.put(ExecuteJob(compile_job.job_id, compile_job.attempt, compile_job.job_dir, out.output, live_log.offset, compile_job.timestamps, compile_job.trace_id))
+            return True
+        elif out.returncode > 0:
+            complete_queue.put(
+                CompleteJob(compile_job.job_id, compile_job.attempt, compile_job.job_dir, False, out.output, None, compile_failed=True, timestamps=compile_job.timestamps, trace_id=compile_job.trace_id)
+            )
+        else:
+            # nvcc was killed by a signal, for instance by the OOM killer, which says nothing about
+            # whether the source compiles.
+            put_fail(f"Compilation was killed by signal {-out.returncode}. Output log:\n\n" + out.output)
+    except Exception as e:
+        put_fail("Compilation failed with exception:\n" + str(e))
 
-def execute_worker(execute_queue, complete_queue, gpu_index: int):
+def execute_worker(execute_queue, job_credits: Credits, complete_queue, log_queue, in_flight, gpu_index: int, cpus: Optional[list], metrics: StageMetrics):
+    pin_cpus(cpus)
     while True:
         execute_job: ExecuteJob = execute_queue.get()
-        put_complete = (
-            lambda success, log: complete_queue.put(
-                CompleteJob(execute_job.job_id, execute_job.job_dir, success, execute_job.compile_log, log)
-            )
-        )
+        started = time.time()
+        execute_job.timestamps["execute_started"] = started
+        metrics.observe("execute_wait", started - execute_job.timestamps["compiled"])
         try:
-            out = subprocess.run(
-                [bin_path(execute_job.job_dir)],
-                timeout=execute_timeout,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                env={**os.environ, "CUDA_VISIBLE_DEVICES": str(gpu_index)},
-                cwd=execute_job.job_dir,
-            )
-            if out.returncode == 0:
-                put_complete(True, out.stdout)
-            else:
-                put_complete(False, out.stdout)
-        except subprocess.TimeoutExpired:
+            run_execute(execute_job, complete_queue, log_queue, in_flight, gpu_index)
+        finally:
+            metrics.observe("execute", execute_job.timestamps.get("completed", time.time()) - started)
+            job_credits.give_back()
+
+def run_execute(execute_job: ExecuteJob, complete_queue, log_queue, in_flight, gpu_index: int):
+    is_cancelled = lambda: in_flight.get((execute_job.job_id, execute_job.attempt), False)
+    put_complete = (
+        lambda success, log: complete_queue.put(
+            CompleteJob(execute_job.job_id, execute_job.attempt, execute_job.job_dir, success, execute_job.compile_log, log, timestamps=execute_job.timestamps, trace_id=execute_job.trace_id)
+        )
+    )
+    if is_cancelled():
+        put_cancelled(complete_queue, execute_job)
+        return
+    try:
+        out = run_captured(
+            [bin_path(execute_job.job_dir)],
+            timeout=execute_timeout,
+            live_log=LiveLog(log_queue, execute_job.job_id, execute_job.attempt, execute_job.live_log_offset),
+            is_cancelled=is_cancelled,
+            # GPUs are numbered in PCI bus order, as nvidia-smi and the topology map number them,
+            # rather than CUDA's default of fastest first.
+            env={**os.environ, "CUDA_DEVICE_ORDER": "PCI_BUS_ID", "CUDA_VISIBLE_DEVICES": str(gpu_index)},
+            cwd=execute_job.job_dir,
+        )
+        if out.cancelled:
+            put_cancelled(complete_queue, execute_job)
+        elif out.timed_out:
             put_complete(
                 False,
-                f"Execution timed out after {execute_timeout} seconds. Output log:\n\n" + out.stdout,
+                f"Execution timed out after {execute_timeout} seconds. Output log:\n\n" + out.output,
             )
-        except Exception as e:
-            put_complete(False, "Execution failed with exception:\n" + str(e))
+        elif out.returncode == 0:
+            put_complete(True, out.output)
+        else:
+            put_complete(False, out.output)
+    except Exception as e:
+        put_complete(False, "Execution failed with exception:\n" + str(e))
 
-def truncate_text(text, max_length):
-    if len(text) > max_length:
-        return text[:max_length // 2] + "\n--- truncated... ---\n" + text[-max_length // 2:]
-    else:
-        return text
+def complete_worker(complete_queue, log_queue, in_flight, server: str, cert: str, auth, nthreads: int, workspaces: Workspaces, metrics: StageMetrics):
+    # Uploads run on several threads, so that one slow upload does not hold up the rest, and
+    # 'complete_queue' is unbounded, so that compile and execute workers never wait on uploads.
+    ssl_ctx = ssl.create_default_context(cadata=cert)
+    pool = ConnectionPool(server, ssl_ctx, max_idle=nthreads + 2)
+    # Jobs are only ever removed from 'in_flight' by this process, and this lock ensures that the
+    # heartbeat never marks a job as cancelled after it has been removed.
+    in_flight_lock = threading.Lock()
+    toolchain = toolchain_id(get_nvcc_version())
+    threads = [
+        threading.Thread(target=upload_worker, args=(complete_queue, in_flight, in_flight_lock, pool, auth, toolchain, workspaces, metrics), daemon=True)
+        for _ in range(nthreads)
+    ]
+    threads.append(threading.Thread(target=log_upload_worker, args=(log_queue, pool, auth), daemon=True))
+    threads.append(threading.Thread(target=heartbeat_worker, args=(in_flight, in_flight_lock, pool, auth), daemon=True))
+    # Job directories are emptied for reuse on their own thread, after the results are uploaded.
+    threads.append(threading.Thread(target=workspaces.cleanup_worker, args=(metrics,), daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def job_spans(timestamps: dict, upload_started: float) -> list:
+    # Describes how the executor spent its time on a job, as spans for the job's timeline on the
+    # queue server. The upload span is left open, and ended by the server when the result arrives.
+    ms = lambda t: int(t * 1000)
+    # A job which failed to compile finishes compiling when it completes.
+    compiled = timestamps.get("compiled", timestamps["completed"])
+    bounds = [
+        ("claim", timestamps.get("claim_started"), timestamps.get("claimed")),
+        ("compile_wait", timestamps.get("claimed"), timestamps.get("compile_started")),
+        ("compile", timestamps.get("compile_started"), compiled),
+        ("execute_wait", timestamps.get("compiled"), timestamps.get("execute_started")),
+        ("execute", timestamps.get("execute_started"), timestamps["completed"]),
+        ("upload_wait", timestamps["completed"], upload_started),
+    ]
+    spans = [
+        {"name": name, "start_unix_ms": ms(start), "end_unix_ms": ms(end)}
+        for name, start, end in bounds
+        if start is not None and end is not None
+    ]
+    spans.append({"name": "upload", "start_unix_ms": ms(upload_started)})
+    return spans
 
-def complete_worker(complete_queue, auth):
-    ssl_ctx = ssl.create_default_context(cadata=server_cert)
+def encode_result(completion: CompleteJob, toolchain: Optional[str], upload_started: float) -> bytes:
+    return json.dumps({
+        "job_id": completion.job_id,
+        "attempt": completion.attempt,
+        "result_json": {
+            "success": completion.success,
+            "compile_log": completion.compile_log,
+            "execute_log": completion.execute_log if completion.execute_log is not None else "",
+            "compile_failed": completion.compile_failed,
+            "compute_capability": compute_capability,
+            "toolchain": toolchain,
+        },
+        "trace_id": completion.trace_id,
+        "spans": job_spans(completion.timestamps, upload_started),
+    }).encode("utf-8")
 
+def upload_worker(complete_queue, in_flight, in_flight_lock, pool, auth, toolchain: Optional[str], workspaces: Workspaces, metrics: StageMetrics):
     auth_name = auth["executor"]
     auth_token = auth["token"]
 
+    # A completed job taken from the queue which did not fit in the previous batch, with its
+    # encoded result.
+    carried_over = None
+
     while True:
-        completion: CompleteJob = complete_queue.get()
+        # Wait for one completed job, then opportunistically batch any others that are already
+        # waiting to be uploaded, as long as they fit.
+        if carried_over is not None:
+            batch = [carried_over]
+            carried_over = None
+        else:
+            completion = complete_queue.get()
+            batch = [(completion, encode_result(completion, toolchain, time.time()))]
+        batch_size = len(batch[0][1])
+        while len(batch) < max_upload_batch:
+            try:
+                completion = complete_queue.get_nowait()
+            except queue.Empty:
+                break
+            encoded = encode_result(completion, toolchain, time.time())
+            if batch_size + len(encoded) + 2 > max_upload_size:
+                carried_over = (completion, encoded)
+                break
+            batch.append((completion, encoded))
+            batch_size += len(encoded) + 2
+
+        upload_started = time.time()
+        retry_interval = upload_retry_interval
         try:
-            shutil.rmtree(completion.job_dir, ignore_errors=True)
+            while True:
+                # Jobs which were cancelled, or whose leases were lost while the upload was being
+                # retried, are no longer wanted by the server.
+                with in_flight_lock:
+                    results = [
+                        encoded for completion, encoded in batch
+                        if not completion.cancelled and not in_flight.get((completion.job_id, completion.attempt), True)
+                    ]
+                if len(results) == 0:
+                    break
+                try:
+                    api_request(
+                        pool,
+                        "POST",
+                        "complete",
+                        {"executor": auth_name, "token": auth_token},
+                        body=b'{"results": [' + b", ".join(results) + b"]}",
+                        timeout=lease_request_timeout,
+                    )
+                    break
+                except ApiError as e:
+                    # The server rejected the results themselves, so sending them again won't help.
+                    if e.code < 500:
+                        raise
+                    traceback.print_exc()
+                except Exception as e:
+                    traceback.print_exc()
+                time.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, max_upload_retry_interval)
 
-            completion_req_query = urllib.parse.urlencode({"executor": auth_name, "token": auth_token, "job_id": completion.job_id})
+            uploaded = time.time()
+            for completion, _ in batch:
+                if completion.cancelled:
+                    continue
+                completion.timestamps["uploaded"] = uploaded
+                metrics.observe("upload_wait", upload_started - completion.timestamps["completed"])
+                metrics.observe("upload", uploaded - upload_started)
+                metrics.observe("total", uploaded - completion.timestamps["claimed"])
+        except Exception as e:
+            traceback.print_exc()
+        finally:
+            # Only now that the results have been uploaded (or rejected) do the jobs stop being
+            # reported in heartbeats, which keeps their leases from running out while the upload
+            # is retried.
+            for completion, _ in batch:
+                workspaces.give_back(completion.job_dir)
+                with in_flight_lock:
+                    in_flight.pop((completion.job_id, completion.attempt), None)
 
-            if completion.execute_log is None:
-                completion.execute_log = ""
+def heartbeat_worker(in_flight, in_flight_lock, pool, auth):
+    auth_name = auth["executor"]
+    auth_token = auth["token"]
 
-            completion_data = json.dumps({
-                "result_json": {
-                    "success": completion.success,
-                    "compile_log": truncate_text(completion.compile_log, max_log_length),
-                    "execute_log": truncate_text(completion.execute_log, max_log_length),
-                }
-            }).encode("utf-8")
+    while True:
+        time.sleep(heartbeat_interval)
+        # Renew this executor's leases on the jobs it is working on, and find out which of them have
+        # been cancelled (or requeued, if a lease could not be renewed in time).
+        leases = list(in_flight.keys())
+        if len(leases) == 0:
+            continue
+        try:
+            response = api_request(
+                pool,
+                "POST",
+                "heartbeat",
+                {"executor": auth_name, "token": auth_token},
+                body=json.dumps({
+                    "leases": [{"job_id": job_id, "attempt": attempt} for job_id, attempt in leases],
+                }).encode("utf-8"),
+                timeout=lease_request_timeout,
+            )
+            with in_flight_lock:
+                for lease in response["cancelled"]:
+                    key = (lease["job_id"], lease["attempt"])
+                    if key in in_flight:
+                        in_flight[key] = True
+        except Exception as e:
+            traceback.print_exc()
+
+def log_upload_worker(log_queue, pool, auth):
+    auth_name = auth["executor"]
+    auth_token = auth["token"]
 
-            completion_req = urllib.request.Request(
-                "https://" + server_ip_port + "/api/complete?" + completion_req_query,
-                data=completion_data,
-                method="POST",
+    while True:
+        # Wait for one chunk of output, then collect any others produced within the flush interval.
+        chunks = [log_queue.get()]
+        deadline = time.monotonic() + log_flush_interval
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                chunks.append(log_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # Merge consecutive chunks of the same job.
+        logs = []
+        for job_id, attempt, offset, text in chunks:
+            if len(logs) > 0:
+                last = logs[-1]
+                if (last["job_id"], last["attempt"]) == (job_id, attempt) and last["offset"] + len(last["text"]) == offset:
+                    last["text"] += text
+                    continue
+            logs.append({"job_id": job_id, "attempt": attempt, "offset": offset, "text": text})
+
+        try:
+            api_request(
+                pool,
+                "POST",
+                "log",
+                {"executor": auth_name, "token": auth_token},
+                body=json.dumps({"logs": logs}).encode("utf-8"),
+                timeout=lease_request_timeout,
             )
-            with urllib.request.urlopen(completion_req, context=ssl_ctx) as f:
-                pass
         except Exception as e:
+            # Live logs are best-effort; the full logs are uploaded with the results.
             traceback.print_exc()
-            continue
 
 def main():
     parser = argparse.ArgumentParser()
@@ -235,43 +1240,156 @@ def main():
         "--auth",
         help="Authentication token (defaults to ./auth.json in the same directory as this script)",
     )
+    parser.add_argument(
+        "--server",
+        help=f"Address of the queue server, as host:port (default: {server_ip_port})",
+        default=server_ip_port,
+    )
+    parser.add_argument(
+        "--server-cert",
+        help="File containing the queue server's TLS certificate (default: the certificate of the default server)",
+    )
     parser.add_argument(
         "--scratch-dir",
         help="Directory to store temporary files (default: /tmp)",
         default="/tmp",
     )
+    parser.add_argument(
+        "--workspace-dir",
+        help="Directory to create job workspaces in, such as /dev/shm to keep them on a tmpfs (default: the scratch directory)",
+    )
+    parser.add_argument(
+        "--compile-cache-dir",
+        help="Directory to cache compiled binaries in (default: telerun-compile-cache in the scratch directory)",
+    )
+    parser.add_argument(
+        "--compile-cache-size",
+        type=int,
+        help=f"Size limit of the compile cache in MiB, or 0 to disable it (default: {compile_cache_size})",
+        default=compile_cache_size,
+    )
+    parser.add_argument(
+        "--upload-concurrency",
+        type=int,
+        help=f"Number of concurrent result uploads (default: {upload_concurrency})",
+        default=upload_concurrency,
+    )
+    parser.add_argument(
+        "--compile-ahead",
+        type=int,
+        help=f"Number of jobs per execution worker to claim and compile while the execution workers are busy (default: {compile_ahead})",
+        default=compile_ahead,
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve histograms of the time jobs spend in each stage of the pipeline in the Prometheus text format at http://127.0.0.1:<port>/metrics",
+    )
+    parser.add_argument(
+        "--metrics-log-interval",
+        type=float,
+        help=f"Interval in seconds between summaries of stage times in the log, or 0 to disable them (default: {metrics_log_interval})",
+        default=metrics_log_interval,
+    )
+    parser.add_argument(
+        "--pin-cpus",
+        action="store_true",
+        help="Give each execution worker cores of its own, local to its GPU where possible, and confine the compile workers to the remaining cores",
+    )
+    parser.add_argument(
+        "--execute-cpus",
+        type=int,
+        help=f"Number of cores for each execution worker with --pin-cpus (default: {execute_cpus})",
+        default=execute_cpus,
+    )
+    parser.add_argument(
+        "--topology",
+        help="JSON file describing the NUMA nodes of this machine and the NUMA node of each GPU, used by --pin-cpus instead of detecting them",
+    )
     args = parser.parse_args()
+    if args.compile_ahead < 0:
+        parser.error("--compile-ahead must not be negative")
+    if args.execute_cpus < 1:
+        parser.error("--execute-cpus must be at least 1")
+
+    execute_worker_cpus = [None] * args.nproc_execute
+    compile_worker_cpus = None
+    if args.pin_cpus:
+        topology = load_topology(args.topology) if args.topology else detect_topology()
+        execute_worker_cpus, compile_worker_cpus = assign_cpus(topology, os.sched_getaffinity(0), args.nproc_execute, args.execute_cpus)
+        for i, cpus in enumerate(execute_worker_cpus):
+            print(f"Execution worker {i} (GPU {i}) cores: {cpus if cpus is not None else 'unpinned'}")
+        print(f"Compile worker cores: {compile_worker_cpus if compile_worker_cpus is not None else 'unpinned'}")
 
     token_path = args.auth or os.path.join(os.path.dirname(__file__), "auth.json")
     with open(token_path, "r") as f:
         auth = json.load(f)
+
+    cert = server_cert
+    if args.server_cert is not None:
+        with open(args.server_cert, "r") as f:
+            cert = f.read()
     
-    scratch_uuid = str(uuid.uuid4())
-    scratch_dir = os.path.join(args.scratch_dir, f"executor-{scratch_uuid}")
-    os.makedirs(scratch_dir, exist_ok=True)
+    workspace_dir = args.workspace_dir or args.scratch_dir
+    # Job binaries are run from their workspaces.
+    if os.statvfs(workspace_dir).f_flag & os.ST_NOEXEC:
+        parser.error(f"{workspace_dir} is mounted noexec, so it cannot hold job workspaces")
+
+    # Clean up after executors which crashed or were killed, in the background.
+    threading.Thread(target=sweep_orphaned_dirs, args=(sorted({args.scratch_dir, workspace_dir}),), daemon=True).start()
 
-    compile_queue = multiprocessing.Queue(1)
-    execute_queue = multiprocessing.Queue(1)
-    complete_queue = multiprocessing.Queue(1)
+    # Each claimed job holds a job credit until it has finished executing (or will not be executed),
+    # and a compile credit while it waits for and goes through compilation. The claim worker only
+    # claims a job when both are free, so a job is never claimed until a compile worker can start on
+    # it right away, and at most 'compile_ahead' compiled jobs per execution worker wait to be
+    # executed. Jobs which are not claimed stay in the server's queue, where the fair-share
+    # scheduler (and other executors) can see them.
+    compile_credits = Credits(args.nproc_compile)
+    job_credits = Credits(args.nproc_execute * (1 + args.compile_ahead))
 
-    claim_proc = multiprocessing.Process(target=claim_worker, args=(compile_queue, auth, scratch_dir))
+    # Enough job directories are created up front for every job that can be in the pipeline at once.
+    # More are created on demand while results are waiting to be uploaded.
+    workspaces = Workspaces(create_executor_dir(workspace_dir), args.nproc_execute * (1 + args.compile_ahead))
+
+    metrics = StageMetrics()
+    if args.metrics_port is not None:
+        threading.Thread(target=serve_metrics, args=(metrics, args.metrics_port), daemon=True).start()
+    if args.metrics_log_interval > 0:
+        threading.Thread(target=metrics_log_worker, args=(metrics, args.metrics_log_interval), daemon=True).start()
+
+    # Maps the (job_id, attempt) pairs of the jobs this executor has claimed and not yet finished
+    # with to whether they have been cancelled.
+    manager = multiprocessing.Manager()
+    in_flight = manager.dict()
+
+    compile_queue = multiprocessing.Queue()
+    execute_queue = multiprocessing.Queue()
+    complete_queue = multiprocessing.Queue()
+    log_queue = multiprocessing.Queue()
+
+    claim_proc = multiprocessing.Process(target=claim_worker, args=(compile_queue, job_credits, compile_credits, in_flight, args.server, cert, auth, workspaces, metrics))
     claim_proc.start()
 
+    # The compile cache lives outside this executor's scratch directory, so that it is shared with
+    # other executors on the same machine and survives restarts.
+    cache_dir = args.compile_cache_dir or os.path.join(args.scratch_dir, "telerun-compile-cache")
+    cache_bytes = args.compile_cache_size << 20
+
     compile_procs = [
-        multiprocessing.Process(target=compile_worker, args=(compile_queue, complete_queue, execute_queue))
+        multiprocessing.Process(target=compile_worker, args=(compile_queue, job_credits, compile_credits, complete_queue, execute_queue, log_queue, in_flight, cache_dir, cache_bytes, compile_worker_cpus, metrics))
         for _ in range(args.nproc_compile)
     ]
     for proc in compile_procs:
         proc.start()
     
     execute_procs = [
-        multiprocessing.Process(target=execute_worker, args=(execute_queue, complete_queue, i))
+        multiprocessing.Process(target=execute_worker, args=(execute_queue, job_credits, complete_queue, log_queue, in_flight, i, execute_worker_cpus[i], metrics))
         for i in range(args.nproc_execute)
     ]
     for proc in execute_procs:
         proc.start()
     
-    complete_proc = multiprocessing.Process(target=complete_worker, args=(complete_queue, auth))
+    complete_proc = multiprocessing.Process(target=complete_worker, args=(complete_queue, log_queue, in_flight, args.server, cert, auth, args.upload_concurrency, workspaces, metrics))
     complete_proc.start()
 
     claim_proc.join()
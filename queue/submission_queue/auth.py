@@ -42,6 +42,24 @@ def create_executor(executor_name):
     con.commit()
     return token
 
+def create_admin(admin_name):
+    con = db.connect_to_db()
+    c = con.cursor()
+    
+    # Check if admin already exists
+    c.execute('SELECT * FROM admins WHERE name = ?', (admin_name,))
+    existing_admin = c.fetchone()
+    if existing_admin:
+        raise ValueError("admin already exists")
+    
+    token = secrets.token_hex(32)
+    c.execute('''
+    INSERT INTO admins (name, token)
+    VALUES (?, ?)
+    ''', (admin_name, token))
+    con.commit()
+    return token
+
 def reset_user_token(username):
     con = db.connect_to_db()
     c = con.cursor()
@@ -80,6 +98,25 @@ def reset_executor_token(executor_name):
     con.commit()
     return token
 
+def reset_admin_token(admin_name):
+    con = db.connect_to_db()
+    c = con.cursor()
+    
+    # Check if admin already exists
+    c.execute('SELECT * FROM admins WHERE name = ?', (admin_name,))
+    existing_admin = c.fetchone()
+    if not existing_admin:
+        raise ValueError("admin does not exist")
+    
+    token = secrets.token_hex(32)
+    c.execute('''
+    UPDATE admins
+    SET token = ?
+    WHERE name = ?
+    ''', (token, admin_name))
+    con.commit()
+    return token
+
 def delete_user(username):
     con = db.connect_to_db()
     c = con.cursor()
@@ -112,6 +149,22 @@ def delete_executor(executor_name):
     ''', (executor_name,))
     con.commit()
 
+def delete_admin(admin_name):
+    con = db.connect_to_db()
+    c = con.cursor()
+    
+    # Check if admin already exists
+    c.execute('SELECT * FROM admins WHERE name = ?', (admin_name,))
+    existing_admin = c.fetchone()
+    if not existing_admin:
+        raise ValueError("admin does not exist")
+
+    c.execute('''
+    DELETE FROM admins
+    WHERE name = ?
+    ''', (admin_name,))
+    con.commit()
+
 def get_user_token(username):
     con = db.connect_to_db()
     c = con.cursor()
@@ -134,6 +187,17 @@ def get_executor_token(executor_name):
 
     return executor_token[0]
 
+def get_admin_token(admin_name):
+    con = db.connect_to_db()
+    c = con.cursor()
+
+    c.execute('SELECT token FROM admins WHERE name = ?', (admin_name,))
+    admin_token = c.fetchone()
+    if not admin_token:
+        raise ValueError("Admin does not exist")
+
+    return admin_token[0]
+
 def list_users():
     con = db.connect_to_db()
     c = con.cursor()
@@ -150,6 +214,14 @@ def list_executors():
     executors = c.fetchall()
     return [executor[0] for executor in executors]
 
+def list_admins():
+    con = db.connect_to_db()
+    c = con.cursor()
+
+    c.execute('SELECT name FROM admins')
+    admins = c.fetchall()
+    return [admin[0] for admin in admins]
+
 def create_user_handler(args):
     token = create_user(args.username)
     print(f"Created user {args.username} with token {token}")
@@ -158,6 +230,10 @@ def create_executor_handler(args):
     token = create_executor(args.executor_name)
     print(f"Created executor {args.executor_name} with token {token}")
 
+def create_admin_handler(args):
+    token = create_admin(args.admin_name)
+    print(f"Created admin {args.admin_name} with token {token}")
+
 def reset_user_token_handler(args):
     token = reset_user_token(args.username)
     print(f"User {args.username} token: {token}")
@@ -166,6 +242,10 @@ def reset_executor_token_handler(args):
     token = reset_executor_token(args.executor_name)
     print(f"Executor {args.executor_name} token: {token}")
 
+def reset_admin_token_handler(args):
+    token = reset_admin_token(args.admin_name)
+    print(f"Admin {args.admin_name} token: {token}")
+
 def delete_user_handler(args):
     delete_user(args.username)
     print(f"Deleted user {args.username}")
@@ -174,6 +254,10 @@ def delete_executor_handler(args):
     delete_executor(args.executor_name)
     print(f"Deleted executor {args.executor_name}")
 
+def delete_admin_handler(args):
+    delete_admin(args.admin_name)
+    print(f"Deleted admin {args.admin_name}")
+
 def get_user_token_handler(args):
     token = get_user_token(args.username)
     print(f"User {args.username} token: {token}")
@@ -182,6 +266,10 @@ def get_executor_token_handler(args):
     token = get_executor_token(args.executor_name)
     print(f"Executor {args.executor_name} token: {token}")
 
+def get_admin_token_handler(args):
+    token = get_admin_token(args.admin_name)
+    print(f"Admin {args.admin_name} token: {token}")
+
 def list_users_handler(args):
     users = list_users()
     print(json.dumps(users, indent=2))
@@ -190,6 +278,10 @@ def list_executors_handler(args):
     executors = list_executors()
     print(json.dumps(executors, indent=2))
 
+def list_admins_handler(args):
+    admins = list_admins()
+    print(json.dumps(admins, indent=2))
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -233,6 +325,26 @@ def main():
     list_executors_parser = subparsers.add_parser('list-executors', help='List all executors')
     list_executors_parser.set_defaults(func=list_executors_handler)
 
+    # Admins may read the queue server's metrics.
+    create_admin_parser = subparsers.add_parser('create-admin', help='Create a new admin')
+    create_admin_parser.add_argument('admin_name', help='The name of the new admin')
+    create_admin_parser.set_defaults(func=create_admin_handler)
+
+    reset_admin_token_parser = subparsers.add_parser('reset-admin-token', help='Reset the token of an admin')
+    reset_admin_token_parser.add_argument('admin_name', help='The name of the admin')
+    reset_admin_token_parser.set_defaults(func=reset_admin_token_handler)
+
+    delete_admin_parser = subparsers.add_parser('delete-admin', help='Delete an admin')
+    delete_admin_parser.add_argument('admin_name', help='The name of the admin to delete')
+    delete_admin_parser.set_defaults(func=delete_admin_handler)
+
+    get_admin_token_parser = subparsers.add_parser('get-admin-token', help='Get the token of an admin')
+    get_admin_token_parser.add_argument('admin_name', help='The name of the admin')
+    get_admin_token_parser.set_defaults(func=get_admin_token_handler)
+
+    list_admins_parser = subparsers.add_parser('list-admins', help='List all admins')
+    list_admins_parser.set_defaults(func=list_admins_handler)
+
     args = parser.parse_args()
     args.func(args)
 
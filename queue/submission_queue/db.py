@@ -1,6 +1,8 @@
 import sqlite3
 import os
 import argparse
+import json
+import zlib
 
 def init_auth_schema(cur):
     cur.execute('''
@@ -15,6 +17,12 @@ def init_auth_schema(cur):
         token TEXT NOT NULL
     )
     ''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS admins (
+        name TEXT NOT NULL PRIMARY KEY,
+        token TEXT NOT NULL
+    )
+    ''')
 
 def init_submission_schema(cur):
     cur.execute('''
@@ -55,6 +63,442 @@ def init_submission_schema(cur):
     )
     ''')
 
+# SQLite expression converting an ISO 8601 timestamp to integer milliseconds since the Unix epoch.
+def iso_8601_to_unix_ms(column):
+    return f"CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER)"
+
+def migrate_add_expiry(cur):
+    # 'expires_at_unix_ms' records when the reaper should act on a claimed or completed job, so
+    # that it can find expired jobs with an index lookup instead of parsing every row's timestamps.
+    cur.execute('''
+    ALTER TABLE jobs ADD COLUMN expires_at_unix_ms INTEGER
+    ''')
+    # Backfill using the 10 minute expiry ages in effect when this migration was written.
+    cur.execute(f'''
+    UPDATE jobs
+    SET expires_at_unix_ms = {iso_8601_to_unix_ms('claimed_at_iso_8601')} + 600000
+    WHERE state = 'claimed'
+    ''')
+    cur.execute(f'''
+    UPDATE jobs
+    SET expires_at_unix_ms = {iso_8601_to_unix_ms('completed_at_iso_8601')} + 600000
+    WHERE state = 'complete'
+    ''')
+    cur.execute('''
+    CREATE INDEX IF NOT EXISTS jobs_by_expiry ON jobs (expires_at_unix_ms)
+    ''')
+
+def migrate_unix_ms_timestamps(cur):
+    # Replace the ISO 8601 text timestamps with integer milliseconds since the Unix epoch, and add
+    # the indexes used by the claim, pending-job and garbage collection queries. SQLite cannot
+    # alter CHECK constraints in place, so both tables are rebuilt.
+    cur.execute('''
+    CREATE TABLE jobs_new (
+        id INTEGER NOT NULL PRIMARY KEY,
+        username TEXT NOT NULL,
+        submitted_at_unix_ms INTEGER NOT NULL,
+        claimed_at_unix_ms INTEGER,
+        completed_at_unix_ms INTEGER,
+        expires_at_unix_ms INTEGER,
+        request_json TEXT NOT NULL,
+        result_json TEXT,
+        state TEXT NOT NULL,
+        FOREIGN KEY(username) REFERENCES users(username) ON DELETE CASCADE,
+        CHECK (
+            (state = 'pending' AND
+                claimed_at_unix_ms IS NULL AND
+                completed_at_unix_ms IS NULL AND
+                result_json IS NULL
+            ) OR
+            (state = 'claimed' AND
+                claimed_at_unix_ms IS NOT NULL AND
+                completed_at_unix_ms IS NULL AND
+                result_json IS NULL
+            ) OR
+            (state = 'complete' AND
+                claimed_at_unix_ms IS NOT NULL AND
+                completed_at_unix_ms IS NOT NULL AND
+                result_json IS NOT NULL
+            )
+        )
+    )
+    ''')
+    cur.execute(f'''
+    INSERT INTO jobs_new
+    SELECT
+        id,
+        username,
+        {iso_8601_to_unix_ms('submitted_at_iso_8601')},
+        {iso_8601_to_unix_ms('claimed_at_iso_8601')},
+        {iso_8601_to_unix_ms('completed_at_iso_8601')},
+        expires_at_unix_ms,
+        request_json,
+        result_json,
+        state
+    FROM jobs
+    ''')
+    cur.execute('''
+    DROP TABLE jobs
+    ''')
+    cur.execute('''
+    ALTER TABLE jobs_new RENAME TO jobs
+    ''')
+    cur.execute('''
+    CREATE INDEX jobs_by_expiry ON jobs (expires_at_unix_ms)
+    ''')
+    cur.execute('''
+    CREATE INDEX jobs_by_state_and_submission ON jobs (state, submitted_at_unix_ms, username)
+    ''')
+    cur.execute('''
+    CREATE INDEX jobs_by_user_and_state ON jobs (username, state, submitted_at_unix_ms)
+    ''')
+
+    cur.execute('''
+    CREATE TABLE priorities_new (
+        username TEXT NOT NULL UNIQUE,
+        last_served_unix_ms INTEGER,
+        FOREIGN KEY(username) REFERENCES users(username) ON DELETE CASCADE
+    )
+    ''')
+    cur.execute(f'''
+    INSERT INTO priorities_new
+    SELECT username, {iso_8601_to_unix_ms('last_served_iso_8601')}
+    FROM priorities
+    ''')
+    cur.execute('''
+    DROP TABLE priorities
+    ''')
+    cur.execute('''
+    ALTER TABLE priorities_new RENAME TO priorities
+    ''')
+    cur.execute('''
+    CREATE INDEX priorities_by_last_served ON priorities (last_served_unix_ms, username)
+    ''')
+
+def migrate_add_compile_failures(cur):
+    # Compile logs of sources known to fail compilation, so that resubmissions of the same broken
+    # source can be completed without being dispatched to an executor.
+    cur.execute('''
+    CREATE TABLE compile_failures (
+        source_sha256 TEXT NOT NULL,
+        compute_capability TEXT NOT NULL,
+        compile_log TEXT NOT NULL,
+        expires_at_unix_ms INTEGER NOT NULL,
+        PRIMARY KEY (source_sha256, compute_capability)
+    )
+    ''')
+    cur.execute('''
+    CREATE INDEX compile_failures_by_expiry ON compile_failures (expires_at_unix_ms)
+    ''')
+
+# Results are stored as zlib-compressed JSON, since they consist mostly of compiler and program
+# logs, which compress well.
+def compress_result(result):
+    return zlib.compress(json.dumps(result).encode("utf-8"))
+
+def migrate_job_results(cur):
+    # Move results out of the jobs table into 'job_results', compressed, so that the rows scanned
+    # by claims, status polls and garbage collection stay small. Results are deleted along with
+    # their jobs by a trigger. The jobs table is rebuilt to drop the 'result_json' column and the
+    # CHECK constraints which refer to it.
+    cur.execute('''
+    CREATE TABLE job_results (
+        job_id INTEGER NOT NULL PRIMARY KEY,
+        result_zlib BLOB NOT NULL
+    )
+    ''')
+    cur.execute('''
+    SELECT id, result_json FROM jobs
+    WHERE result_json IS NOT NULL
+    ''')
+    for job_id, result_json in cur.fetchall():
+        # Results were stored as the executor's request body, nested under 'result_json'.
+        result = json.loads(result_json)["result_json"]
+        cur.execute('''
+        INSERT INTO job_results (job_id, result_zlib)
+        VALUES (?, ?)
+        ''', (job_id, compress_result(result)))
+
+    cur.execute('''
+    CREATE TABLE jobs_new (
+        id INTEGER NOT NULL PRIMARY KEY,
+        username TEXT NOT NULL,
+        submitted_at_unix_ms INTEGER NOT NULL,
+        claimed_at_unix_ms INTEGER,
+        completed_at_unix_ms INTEGER,
+        expires_at_unix_ms INTEGER,
+        request_json TEXT NOT NULL,
+        state TEXT NOT NULL,
+        FOREIGN KEY(username) REFERENCES users(username) ON DELETE CASCADE,
+        CHECK (
+            (state = 'pending' AND
+                claimed_at_unix_ms IS NULL AND
+                completed_at_unix_ms IS NULL
+            ) OR
+            (state = 'claimed' AND
+                claimed_at_unix_ms IS NOT NULL AND
+                completed_at_unix_ms IS NULL
+            ) OR
+            (state = 'complete' AND
+                claimed_at_unix_ms IS NOT NULL AND
+                completed_at_unix_ms IS NOT NULL
+            )
+        )
+    )
+    ''')
+    cur.execute('''
+    INSERT INTO jobs_new
+    SELECT
+        id,
+        username,
+        submitted_at_unix_ms,
+        claimed_at_unix_ms,
+        completed_at_unix_ms,
+        expires_at_unix_ms,
+        request_json,
+        state
+    FROM jobs
+    ''')
+    cur.execute('''
+    DROP TABLE jobs
+    ''')
+    cur.execute('''
+    ALTER TABLE jobs_new RENAME TO jobs
+    ''')
+    cur.execute('''
+    CREATE INDEX jobs_by_expiry ON jobs (expires_at_unix_ms)
+    ''')
+    cur.execute('''
+    CREATE INDEX jobs_by_state_and_submission ON jobs (state, submitted_at_unix_ms, username)
+    ''')
+    cur.execute('''
+    CREATE INDEX jobs_by_user_and_state ON jobs (username, state, submitted_at_unix_ms)
+    ''')
+    cur.execute('''
+    CREATE TRIGGER jobs_delete_result AFTER DELETE ON jobs
+    BEGIN
+        DELETE FROM job_results WHERE job_id = OLD.id;
+    END
+    ''')
+
+def migrate_never_reuse_job_ids(cur):
+    # Without AUTOINCREMENT, SQLite reuses the id of the most recently inserted job once that job
+    # is deleted. Job ids are how clients and executors refer to jobs, and an executor must never
+    # mistake a new job for a cancelled one with the same id, so the jobs table is rebuilt with
+    # AUTOINCREMENT. The sequence starts after the largest id in use.
+    cur.execute('''
+    CREATE TABLE jobs_new (
+        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        submitted_at_unix_ms INTEGER NOT NULL,
+        claimed_at_unix_ms INTEGER,
+        completed_at_unix_ms INTEGER,
+        expires_at_unix_ms INTEGER,
+        request_json TEXT NOT NULL,
+        state TEXT NOT NULL,
+        FOREIGN KEY(username) REFERENCES users(username) ON DELETE CASCADE,
+        CHECK (
+            (state = 'pending' AND
+                claimed_at_unix_ms IS NULL AND
+                completed_at_unix_ms IS NULL
+            ) OR
+            (state = 'claimed' AND
+                claimed_at_unix_ms IS NOT NULL AND
+                completed_at_unix_ms IS NULL
+            ) OR
+            (state = 'complete' AND
+                claimed_at_unix_ms IS NOT NULL AND
+                completed_at_unix_ms IS NOT NULL
+            )
+        )
+    )
+    ''')
+    cur.execute('''
+    INSERT INTO jobs_new
+    SELECT
+        id,
+        username,
+        submitted_at_unix_ms,
+        claimed_at_unix_ms,
+        completed_at_unix_ms,
+        expires_at_unix_ms,
+        request_json,
+        state
+    FROM jobs
+    ''')
+    cur.execute('''
+    DROP TABLE jobs
+    ''')
+    cur.execute('''
+    ALTER TABLE jobs_new RENAME TO jobs
+    ''')
+    cur.execute('''
+    CREATE INDEX jobs_by_expiry ON jobs (expires_at_unix_ms)
+    ''')
+    cur.execute('''
+    CREATE INDEX jobs_by_state_and_submission ON jobs (state, submitted_at_unix_ms, username)
+    ''')
+    cur.execute('''
+    CREATE INDEX jobs_by_user_and_state ON jobs (username, state, submitted_at_unix_ms)
+    ''')
+    cur.execute('''
+    CREATE TRIGGER jobs_delete_result AFTER DELETE ON jobs
+    BEGIN
+        DELETE FROM job_results WHERE job_id = OLD.id;
+    END
+    ''')
+
+def migrate_add_leases(cur):
+    # A claim is now a renewable lease: 'expires_at_unix_ms' of a claimed job is when its lease
+    # runs out unless the executor holding it ('claimed_by') renews it. Jobs whose leases run out
+    # are requeued, and 'attempts' counts how many times a job has been claimed.
+    cur.execute('''
+    ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0
+    ''')
+    cur.execute('''
+    ALTER TABLE jobs ADD COLUMN claimed_by TEXT
+    ''')
+    cur.execute('''
+    UPDATE jobs
+    SET attempts = 1
+    WHERE state != 'pending'
+    ''')
+
+def migrate_add_traces(cur):
+    # Each job gets a trace ID when it is submitted, and a timeline of spans recorded by the queue
+    # server and the executors as it moves through the system. Spans are deleted along with their
+    # jobs by a trigger.
+    cur.execute('''
+    ALTER TABLE jobs ADD COLUMN trace_id TEXT
+    ''')
+    cur.execute('''
+    CREATE TABLE job_spans (
+        job_id INTEGER NOT NULL,
+        attempt INTEGER,
+        name TEXT NOT NULL,
+        start_unix_ms INTEGER NOT NULL,
+        end_unix_ms INTEGER NOT NULL
+    )
+    ''')
+    cur.execute('''
+    CREATE INDEX job_spans_by_job ON job_spans (job_id, start_unix_ms)
+    ''')
+    cur.execute('''
+    CREATE TRIGGER jobs_delete_spans AFTER DELETE ON jobs
+    BEGIN
+        DELETE FROM job_spans WHERE job_id = OLD.id;
+    END
+    ''')
+
+def migrate_compile_failures_by_toolchain(cur):
+    # Compile failures are also keyed by the toolchain (nvcc version and flags) which the executor
+    # compiled with, so that they stop applying once executors are upgraded. Existing entries don't
+    # say which toolchain they came from, and are only a cache, so they are dropped.
+    cur.execute('''
+    DROP TABLE compile_failures
+    ''')
+    cur.execute('''
+    CREATE TABLE compile_failures (
+        source_sha256 TEXT NOT NULL,
+        compute_capability TEXT NOT NULL,
+        toolchain TEXT NOT NULL,
+        compile_log TEXT NOT NULL,
+        expires_at_unix_ms INTEGER NOT NULL,
+        PRIMARY KEY (source_sha256, compute_capability, toolchain)
+    )
+    ''')
+    cur.execute('''
+    CREATE INDEX compile_failures_by_expiry ON compile_failures (expires_at_unix_ms)
+    ''')
+
+# Schema migrations for the submission tables, applied in order on top of the tables created by
+# 'init_submission_schema'. The database's 'user_version' records how many have been applied.
+# Never edit or reorder existing entries; append new ones.
+submission_migrations = [
+    migrate_add_expiry,
+    migrate_unix_ms_timestamps,
+    migrate_add_compile_failures,
+    migrate_job_results,
+    migrate_never_reuse_job_ids,
+    migrate_add_leases,
+    migrate_add_traces,
+    migrate_compile_failures_by_toolchain,
+]
+
+# Queries issued by the queue server whose cost would otherwise grow with the size of the jobs
+# table. They are kept here so that 'explain-queries' can check that each of them is answered by
+# an index seek or an ordered index walk, rather than by scanning or sorting the jobs table.
+
+# All pending jobs, used to rebuild the server's in-memory scheduler on startup.
+pending_jobs_query = '''
+SELECT id, username, submitted_at_unix_ms
+FROM jobs
+WHERE state = 'pending'
+'''
+
+# A user's earliest-submitted pending job.
+pending_job_for_user_query = '''
+SELECT id
+FROM jobs
+WHERE username = ? AND state = 'pending'
+ORDER BY submitted_at_unix_ms ASC, id ASC
+LIMIT 1
+'''
+
+# Claimed jobs whose leases have run out, and completed jobs due for garbage collection.
+expired_jobs_query = '''
+SELECT id, state FROM jobs
+WHERE expires_at_unix_ms < ?
+LIMIT ?
+'''
+
+# Cached compile failures due for garbage collection.
+expired_compile_failures_query = '''
+SELECT rowid FROM compile_failures
+WHERE expires_at_unix_ms < ?
+LIMIT ?
+'''
+
+# A job's spans, in order.
+job_spans_query = '''
+SELECT attempt, name, start_unix_ms, end_unix_ms
+FROM job_spans
+WHERE job_id = ?
+ORDER BY start_unix_ms ASC
+'''
+
+hot_queries = {
+    "pending_jobs": (pending_jobs_query, ()),
+    "pending_job_for_user": (pending_job_for_user_query, ("",)),
+    "expired_jobs": (expired_jobs_query, (0, 1)),
+    "expired_compile_failures": (expired_compile_failures_query, (0, 1)),
+    "job_spans": (job_spans_query, (0,)),
+}
+
+def explain_hot_queries(cur):
+    # Returns a list of (name, plan lines, ok) for each query in 'hot_queries'. A plan is not ok if
+    # it scans a table without an index, or sorts rows using a temporary b-tree.
+    results = []
+    for name, (query, params) in hot_queries.items():
+        cur.execute('EXPLAIN QUERY PLAN ' + query, params)
+        plan = [row[3] for row in cur.fetchall()]
+        ok = not any(
+            "TEMP B-TREE" in line or (line.startswith("SCAN") and "INDEX" not in line)
+            for line in plan
+        )
+        results.append((name, plan, ok))
+    return results
+
+def migrate_submission_schema(cur):
+    con = cur.connection
+    cur.execute('PRAGMA user_version')
+    version = cur.fetchone()[0]
+    for i in range(version, len(submission_migrations)):
+        cur.execute('BEGIN')
+        submission_migrations[i](cur)
+        cur.execute(f'PRAGMA user_version = {i + 1}')
+        con.commit()
+
 def reset_submissions(cur):
     # drop submissions and priorities tables
     cur.execute('''
@@ -63,23 +507,42 @@ def reset_submissions(cur):
     cur.execute('''
     DROP TABLE IF EXISTS priorities
     ''')
+    cur.execute('''
+    DROP TABLE IF EXISTS compile_failures
+    ''')
+    cur.execute('''
+    DROP TABLE IF EXISTS job_results
+    ''')
+    cur.execute('''
+    DROP TABLE IF EXISTS job_spans
+    ''')
+    cur.execute('''
+    PRAGMA user_version = 0
+    ''')
     # recreate submissions and priorities tables
     init_submission_schema(cur)
+    migrate_submission_schema(cur)
 
 def init_schema(con):
     c = con.cursor()
     init_auth_schema(c)
     init_submission_schema(c)
     con.commit()
+    migrate_submission_schema(c)
+
+def default_db_path():
+    return os.path.join(os.path.dirname(os.path.dirname(__file__)), 'db.sqlite3')
 
-def connect_to_db_no_init():
-    db_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'db.sqlite3')
-    conn = sqlite3.connect(db_path)
+def connect_to_db_no_init(db_path=None):
+    if db_path is None:
+        db_path = default_db_path()
+    # The queue server shares one connection across its handler threads, serializing access itself.
+    conn = sqlite3.connect(db_path, check_same_thread=False)
     init_schema(conn)
     return conn
 
-def connect_to_db():
-    conn = connect_to_db_no_init()
+def connect_to_db(db_path=None):
+    conn = connect_to_db_no_init(db_path)
     init_schema(conn)
     return conn
 
@@ -92,6 +555,17 @@ def reset_submissions_handler(args):
     reset_submissions(conn.cursor())
     conn.close()
 
+def explain_queries_handler(args):
+    conn = connect_to_db()
+    results = explain_hot_queries(conn.cursor())
+    conn.close()
+    for name, plan, ok in results:
+        print(f"{name}: {'ok' if ok else 'NOT INDEXED'}")
+        for line in plan:
+            print("    " + line)
+    if not all(ok for _, _, ok in results):
+        exit(1)
+
 def main():
     parser = argparse.ArgumentParser(description='Submission Queue CLI')
     subparsers = parser.add_subparsers(title='subcommands', dest='subcommand')
@@ -104,6 +578,10 @@ def main():
     reset_submissions_parser = subparsers.add_parser('reset-submissions', help='Reset the submissions table')
     reset_submissions_parser.set_defaults(func=reset_submissions_handler)
 
+    # explain-queries subcommand
+    explain_queries_parser = subparsers.add_parser('explain-queries', help='Check that the queue server\'s hot queries use indexes')
+    explain_queries_parser.set_defaults(func=explain_queries_handler)
+
     args = parser.parse_args()
     if hasattr(args, 'func'):
         args.func(args)
@@ -0,0 +1,27 @@
+import threading
+
+class JobWaiters:
+    # Conditions on which long-polling requests wait for something to happen to a particular job,
+    # so that a change to one job only wakes the requests waiting on that job. Like the scheduler,
+    # this must only be used while holding the server's database lock, which is given as 'lock'.
+
+    def __init__(self, lock):
+        self.lock = lock
+        # job_id -> [condition, number of waiting requests]; entries only exist while requests are
+        # waiting on them.
+        self.waiters = {}
+
+    def wait(self, job_id, timeout):
+        # Releases the lock until 'notify' is called for the job, or 'timeout' seconds pass.
+        waiter = self.waiters.setdefault(job_id, [threading.Condition(self.lock), 0])
+        waiter[1] += 1
+        try:
+            waiter[0].wait(timeout)
+        finally:
+            waiter[1] -= 1
+            if waiter[1] == 0:
+                del self.waiters[job_id]
+
+    def notify(self, job_id):
+        if job_id in self.waiters:
+            self.waiters[job_id][0].notify_all()
@@ -0,0 +1,53 @@
+class LiveLogs:
+    # In-memory buffers of the output of claimed jobs, streamed by executors while the jobs run, so
+    # that clients can tail them before the jobs complete.
+    #
+    # Each job's live log is an append-only stream of text, addressed by character offsets from its
+    # start. Only the last 'max_length' characters of each stream are retained; a reader which falls
+    # further behind skips ahead to the oldest retained character. Live logs are not durable, and
+    # are discarded as soon as their jobs stop running. Like the scheduler, this must only be used
+    # while holding the server's database lock.
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+        # job_id -> [start_offset, text], where 'text' is the retained suffix of the stream
+        self.logs = {}
+
+    def __len__(self):
+        return len(self.logs)
+
+    def job_ids(self):
+        return list(self.logs)
+
+    def append(self, job_id, offset, text):
+        # Appends 'text', which starts at 'offset' in the stream. Text already in the stream (from a
+        # retried request) is ignored. If 'offset' is past the end of the stream, because some
+        # earlier text was lost, the stream skips ahead to it.
+        log = self.logs.setdefault(job_id, [0, ""])
+        start, buffered = log
+        end = start + len(buffered)
+        if offset + len(text) <= end:
+            return
+        if offset > end:
+            buffered = ""
+            start = offset
+            end = offset
+        buffered += text[end - offset:]
+        if len(buffered) > self.max_length:
+            start += len(buffered) - self.max_length
+            buffered = buffered[-self.max_length:]
+        log[0] = start
+        log[1] = buffered
+
+    def read(self, job_id, offset):
+        # Returns (start, text) for the retained text from 'offset' onwards. 'start' is later than
+        # 'offset' if the text in between is no longer retained.
+        if job_id not in self.logs:
+            return offset, ""
+        start, buffered = self.logs[job_id]
+        end = start + len(buffered)
+        offset = max(min(offset, end), start)
+        return offset, buffered[offset - start:]
+
+    def discard(self, job_id):
+        self.logs.pop(job_id, None)
@@ -3,25 +3,239 @@ import ssl
 import os
 import time
 import json
+import threading
+import contextlib
+import argparse
+import hashlib
+import secrets
+import zlib
+import gzip
 from datetime import datetime, timezone
 from urllib.parse import urlparse, parse_qs
 import traceback
 
 import submission_queue.db as db
+from submission_queue.scheduler import FairShareScheduler
+from submission_queue.live_logs import LiveLogs
+from submission_queue.job_waiters import JobWaiters
+from submission_queue.metrics import ServerMetrics
 
 max_submit_size = 1 << 20 # 1 MB
+# A batch of results from an executor, each of which may carry up to two 1 MB logs.
+max_complete_size = 1 << 26 # 64 MB
+
+# Responses at least this large are compressed, if the client accepts a compressed encoding.
+min_compress_size = 1024 # bytes
 
 max_completed_job_age = 60 * 10 # 10 minutes
-max_claimed_job_age = 60 * 10 # 10 minutes
+
+# Claiming a job grants the executor a lease on it, which the executor renews with heartbeats
+# while it works on the job. If the lease runs out, the executor is presumed dead and the job is
+# requeued, unless it has already been claimed 'max_attempts' times, in which case it fails.
+lease_duration = 10 # seconds
+max_attempts = 3
+
+# Expired jobs are deleted, and jobs with expired leases requeued, by a background reaper thread,
+# which wakes up every 'gc_interval' seconds and handles at most 'gc_batch_size' jobs per
+# transaction.
+gc_interval = 2 # seconds
+gc_batch_size = 500
+
+# The GPU architecture targeted by the executors. Sources which are known to fail to compile for
+# this architecture are completed immediately with the cached compile log, rather than being
+# dispatched to an executor again.
+compute_capability = "86"
+compile_failure_ttl = 60 * 60 * 24 # 1 day
+max_compile_failures = 10000
+max_cached_compile_log = 1 << 16 # 64 KB
+
+# Connections that stay silent for this long are dropped, so that slow or stalled clients cannot
+# pin a handler thread forever.
+request_timeout = 60 # seconds
+
+# Upper bound on how long a long-polling claim request may be held open.
+max_claim_wait = 30 # seconds
+
+# Upper bound on how long a long-polling status request may be held open.
+max_status_wait = 30 # seconds
+
+# Upper bound on how long a long-polling live log request may be held open.
+max_log_wait = 30 # seconds
+
+# Only the most recent output of each running job is kept for live log requests.
+max_live_log_length = 1 << 18 # 256 KB
+
+# Upper bound on how many jobs a single claim request may claim at once.
+max_claim_batch = 64
+
+# Request metrics are recorded per endpoint, and requests to any other path are counted together.
+metrics_paths = [
+    "/api/status",
+    "/api/result",
+    "/api/log",
+    "/api/submit",
+    "/api/delete",
+    "/api/claim",
+    "/api/complete",
+    "/api/heartbeat",
+    "/api/metrics",
+    "/api/trace",
+]
+
+# Number of connections the kernel may queue up while all handler threads are busy accepting.
+listen_backlog = 128
+
+def accepted_encodings(accept_encoding):
+    # Returns the set of content codings listed in an Accept-Encoding header, other than those
+    # explicitly refused with 'q=0'.
+    encodings = set()
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        encodings.add(coding.strip().lower())
+    return encodings
+
+def decode_request_body(data, content_encoding, limit):
+    # Returns the request body with its content coding removed, or None if it would be larger than
+    # 'limit' bytes once decoded. The decoded size is checked as it is decompressed, so that a small
+    # compressed body cannot expand into an arbitrarily large one.
+    if content_encoding in (None, "identity"):
+        return data if len(data) <= limit else None
+    if content_encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif content_encoding == "deflate":
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+    else:
+        raise ValueError(f"Unsupported Content-Encoding: {content_encoding}")
+    decoded = decompressor.decompress(data, limit + 1)
+    if len(decoded) > limit:
+        return None
+    if not decompressor.eof:
+        raise ValueError("Truncated request body")
+    return decoded
 
 def main():
-    con = db.connect_to_db()
+    queue_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="", help="Address to listen on (default: all interfaces)")
+    parser.add_argument("--port", type=int, default=4443, help="Port to listen on (default: 4443)")
+    parser.add_argument(
+        "--db",
+        default=db.default_db_path(),
+        help="SQLite database file (default: db.sqlite3 in the queue directory)",
+    )
+    parser.add_argument(
+        "--certfile",
+        default=os.path.join(queue_dir, "cert", "server.crt"),
+        help="TLS certificate file (default: cert/server.crt in the queue directory)",
+    )
+    parser.add_argument(
+        "--keyfile",
+        default=os.path.join(queue_dir, "cert", "server.key"),
+        help="TLS private key file (default: cert/server.key in the queue directory)",
+    )
+    parser.add_argument(
+        "--audit-log",
+        default=os.path.join(queue_dir, "audit_log.jsonl"),
+        help="File to append every submission to (default: audit_log.jsonl in the queue directory)",
+    )
+    parser.add_argument(
+        "--gc-interval",
+        type=float,
+        default=gc_interval,
+        help=f"Seconds between garbage collection passes (default: {gc_interval})",
+    )
+    parser.add_argument(
+        "--lease-duration",
+        type=float,
+        default=lease_duration,
+        help=f"Seconds an executor may go without renewing its lease on a job before the job is requeued (default: {lease_duration})",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=max_attempts,
+        help=f"Number of times a job may be claimed before it fails instead of being requeued (default: {max_attempts})",
+    )
+    parser.add_argument(
+        "--compute-capability",
+        default=compute_capability,
+        help=f"GPU architecture targeted by the executors, used to look up cached compile failures (default: {compute_capability})",
+    )
+    parser.add_argument(
+        "--gc-batch-size",
+        type=int,
+        default=gc_batch_size,
+        help=f"Maximum number of jobs deleted per garbage collection transaction (default: {gc_batch_size})",
+    )
+    parser.add_argument(
+        "--span-log",
+        help="Also append every recorded job span to this file, as JSON lines, for offline analysis",
+    )
+    args = parser.parse_args()
+
+    con = db.connect_to_db(args.db)
+
+    scheduler = FairShareScheduler()
+    scheduler.rebuild(con.cursor())
+
+    live_logs = LiveLogs(max_live_log_length)
 
-    audit_log = open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "audit_log.jsonl"), "a")
+    metrics = ServerMetrics()
+
+    # The server handles each connection on its own thread, but all threads share a single SQLite
+    # connection and scheduler. Every transaction must hold this lock. Network I/O (TLS handshakes,
+    # reading request bodies, writing responses) is always done without holding it, so that a slow
+    # client cannot stall anyone else.
+    db_lock = threading.RLock()
+
+    # Signalled whenever a new pending job is inserted, to wake up long-polling claim requests.
+    job_available = threading.Condition(db_lock)
+
+    # Long-polling status requests, woken whenever their job changes state (or is deleted).
+    status_waiters = JobWaiters(db_lock)
+
+    # Long-polling live log requests, woken whenever their job has output appended to its live log,
+    # or changes state.
+    live_log_waiters = JobWaiters(db_lock)
+
+    def notify_job_changed(job_id):
+        # Must be called whenever a job changes state or is deleted, while holding the lock.
+        status_waiters.notify(job_id)
+        live_log_waiters.notify(job_id)
+
+    @contextlib.contextmanager
+    def transaction():
+        with db_lock:
+            started = time.monotonic()
+            try:
+                with con:
+                    yield
+            except:
+                # The transaction was rolled back, so the scheduler may hold changes that never
+                # reached the database.
+                scheduler.rebuild(con.cursor())
+                raise
+            finally:
+                metrics.observe_transaction(time.monotonic() - started)
+
+    audit_log = open(args.audit_log, "a")
+
+    span_log = open(args.span_log, "a") if args.span_log else None
 
     def curr_timestamp():
         return datetime.now(timezone.utc).isoformat()
 
+    def curr_unix_ms():
+        return int(time.time() * 1000)
+
     def authenticate_user(username, token):
         c = con.cursor()
         c.execute('''
@@ -37,152 +251,566 @@ def main():
         WHERE name = ? AND token = ?
         ''', (executor, token))
         return c.fetchone() is not None
-    
-    def has_pending_job(username):
+
+    def authenticate_admin(admin, token):
         c = con.cursor()
         c.execute('''
-        SELECT * FROM jobs
-        WHERE username = ? AND state = 'pending'
-        ''', (username,))
+        SELECT * FROM admins
+        WHERE name = ? AND token = ?
+        ''', (admin, token))
         return c.fetchone() is not None
     
-    def submit_job(username, request_json):
+    def pending_job(username):
+        # returns the id of the user's pending job, or None if it has none
+        c = con.cursor()
+        c.execute(db.pending_job_for_user_query, (username,))
+        result = c.fetchone()
+        if result is None:
+            return None
+        return result[0]
+    
+    def source_sha256(request_json):
+        source = request_json.get("source")
+        if not isinstance(source, str):
+            return None
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    # The toolchain reported by the executor which most recently completed a job. Compile failures
+    # are only reused while executors still compile with the toolchain which failed them.
+    current_toolchain = None
+
+    def lookup_compile_failure(request_json):
+        # returns the cached compile log if the submitted source is known to fail to compile
+        source_hash = source_sha256(request_json)
+        if source_hash is None or current_toolchain is None:
+            return None
         c = con.cursor()
-        
         c.execute('''
-        DELETE FROM jobs
+        SELECT compile_log FROM compile_failures
+        WHERE source_sha256 = ? AND compute_capability = ? AND toolchain = ? AND expires_at_unix_ms >= ?
+        ''', (source_hash, args.compute_capability, current_toolchain, curr_unix_ms()))
+        result = c.fetchone()
+        if result is None:
+            return None
+        return result[0]
+
+    def record_compile_failure(request_json, result):
+        source_hash = source_sha256(request_json)
+        if source_hash is None:
+            return
+        if result.get("compute_capability") != args.compute_capability:
+            return
+        toolchain = result.get("toolchain")
+        if not isinstance(toolchain, str):
+            return
+        compile_log = result.get("compile_log", "")
+        if len(compile_log) > max_cached_compile_log:
+            return
+        c = con.cursor()
+        c.execute('''
+        INSERT OR REPLACE INTO compile_failures
+            (source_sha256, compute_capability, toolchain, compile_log, expires_at_unix_ms)
+        VALUES (?, ?, ?, ?, ?)
+        ''', (source_hash, args.compute_capability, toolchain, compile_log, curr_unix_ms() + compile_failure_ttl * 1000))
+
+    def submit_job(username, request_json, replace_job_id=None):
+        c = con.cursor()
+
+        # Replace the user's pending job, if any. 'replace_job_id' names the job which the user
+        # meant to replace, if known: it is cancelled even if an executor claimed it in the
+        # meantime, and finds out through its heartbeats. The user's other running jobs are left
+        # alone.
+        c.execute('''
+        SELECT id FROM jobs
         WHERE username = ? AND state = 'pending'
         ''', (username,))
+        replaced_job_ids = [job_id for job_id, in c.fetchall()]
+        if replace_job_id is not None and get_job_status(replace_job_id) == "claimed" and job_owner(replace_job_id) == username:
+            replaced_job_ids.append(replace_job_id)
+        for replaced_job_id in replaced_job_ids:
+            delete_job(replaced_job_id)
+
+        timestamp = curr_unix_ms()
+        trace_id = secrets.token_hex(8)
+
+        cached_compile_log = lookup_compile_failure(request_json)
+        if cached_compile_log is not None:
+            # The source is known not to compile, so complete the job immediately.
+            result = {
+                "success": False,
+                "compile_log": cached_compile_log,
+                "execute_log": "",
+                "compile_failed": True,
+                "cached": True,
+            }
+            c.execute('''
+            INSERT INTO jobs (
+                username,
+                submitted_at_unix_ms,
+                claimed_at_unix_ms,
+                completed_at_unix_ms,
+                expires_at_unix_ms,
+                request_json,
+                state,
+                trace_id
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                username,
+                timestamp,
+                timestamp,
+                timestamp,
+                timestamp + max_completed_job_age * 1000,
+                json.dumps(request_json),
+                "complete",
+                trace_id,
+            ))
+            job_id = c.lastrowid
+            c.execute('''
+            INSERT INTO job_results (job_id, result_zlib)
+            VALUES (?, ?)
+            ''', (job_id, db.compress_result(result)))
+            notify_job_changed(job_id)
+            return job_id, trace_id
 
         c.execute('''
-        INSERT INTO jobs (username, submitted_at_iso_8601, request_json, state)
-        VALUES (?, ?, ?, ?)
-        ''', (username, curr_timestamp(), json.dumps(request_json), "pending"))
+        INSERT INTO jobs (username, submitted_at_unix_ms, request_json, state, trace_id)
+        VALUES (?, ?, ?, ?, ?)
+        ''', (username, timestamp, json.dumps(request_json), "pending", trace_id))
         
         job_id = c.lastrowid
+        scheduler.add(job_id, username, timestamp)
+
+        job_available.notify_all()
+        notify_job_changed(job_id)
         
-        return job_id
+        return job_id, trace_id
     
     def delete_job(job_id):
+        # Deleting a claimed job cancels it: the executor running it is told so by its next
+        # heartbeat.
         c = con.cursor()
 
         c.execute('''
         DELETE FROM jobs
         WHERE id = ?
         ''', (job_id,))
+        scheduler.remove(job_id)
+        live_logs.discard(job_id)
 
-    def claim_job(executor):
-        c = con.cursor()
+        notify_job_changed(job_id)
 
-        # Get the least recently served user that has a pending job. If there are users which have
-        # never been served (i.e. last_served_iso_8601 is NULL) but which have a pending job in
-        # the 'jobs' table, then they should be served first, in order of when they submitted their
-        # pending job.
+    def job_owner(job_id):
+        c = con.cursor()
         c.execute('''
-        SELECT u.username, j.id, j.request_json AS job_id
-        FROM users u
-        JOIN jobs j ON u.username = j.username
-        LEFT JOIN priorities p ON u.username = p.username
-        WHERE j.state = 'pending'
-        ORDER BY 
-            CASE
-                WHEN (p.username is NULL OR p.last_served_iso_8601 IS NULL) THEN 0
-                ELSE 1
-            END ASC,
-            CASE
-                WHEN (p.username is NULL OR p.last_served_iso_8601 IS NULL) THEN j.submitted_at_iso_8601
-                ELSE p.last_served_iso_8601
-            END ASC,
-            j.submitted_at_iso_8601 ASC
-        LIMIT 1
-        ''')
-
+        SELECT username FROM jobs
+        WHERE id = ?
+        ''', (job_id,))
         result = c.fetchone()
         if result is None:
-            return None, None
-        
-        username, job_id, request_json = result
+            return None
+        return result[0]
+
+    def record_spans(job_id, trace_id, attempt, spans):
+        # Adds (name, start_unix_ms, end_unix_ms) spans to the job's timeline.
+        c = con.cursor()
+        c.executemany('''
+        INSERT INTO job_spans (job_id, attempt, name, start_unix_ms, end_unix_ms)
+        VALUES (?, ?, ?, ?, ?)
+        ''', [(job_id, attempt, name, start, end) for name, start, end in spans])
+        if span_log is not None:
+            for name, start, end in spans:
+                span_log.write(json.dumps({
+                    "trace_id": trace_id,
+                    "job_id": job_id,
+                    "attempt": attempt,
+                    "name": name,
+                    "start_unix_ms": start,
+                    "end_unix_ms": end,
+                }))
+                span_log.write("\n")
+            span_log.flush()
+
+    def claim_job(executor):
+        # Claims the next job in fair-share order, returning (job_id, request_json, attempt,
+        # trace_id), or None if there are no pending jobs.
+        c = con.cursor()
+
+        # Get the pending job of the least recently served user, as determined by the scheduler.
+        # Skip any job whose user has since been deleted.
+        while True:
+            next_job = scheduler.pop()
+            if next_job is None:
+                return None
+            job_id, username = next_job
 
-        timestamp = curr_timestamp()
+            c.execute('''
+            SELECT j.request_json, j.attempts, j.submitted_at_unix_ms, j.trace_id
+            FROM jobs j
+            JOIN users u ON u.username = j.username
+            WHERE j.id = ? AND j.state = 'pending'
+            ''', (job_id,))
+            result = c.fetchone()
+            if result is not None:
+                break
+        request_json, attempts, submitted_at, trace_id = result
+        attempt = attempts + 1
 
-        # mark the job as claimed
+        timestamp = curr_unix_ms()
+        metrics.observe_claim((timestamp - submitted_at) / 1000)
+
+        # A requeued job has been waiting since its last lease expired, which ends its timeline.
+        queued_at = submitted_at
+        if attempts > 0:
+            spans = c.execute(db.job_spans_query, (job_id,)).fetchall()
+            queued_at = max([submitted_at] + [end for _, _, _, end in spans])
+        record_spans(job_id, trace_id, attempt, [("queue_wait", queued_at, timestamp)])
+
+        # mark the job as claimed, leased to the executor
         c.execute('''
         UPDATE jobs
-        SET state = 'claimed', claimed_at_iso_8601 = ?
+        SET state = 'claimed', claimed_at_unix_ms = ?, expires_at_unix_ms = ?, claimed_by = ?, attempts = ?
         WHERE id = ?
-        ''', (timestamp, job_id))
+        ''', (timestamp, timestamp + int(args.lease_duration * 1000), executor, attempt, job_id))
 
         # update the last served timestamp for the user
         c.execute('''
-        INSERT INTO priorities (username, last_served_iso_8601)
+        INSERT INTO priorities (username, last_served_unix_ms)
         VALUES (?, ?)
-        ON CONFLICT(username) DO UPDATE SET last_served_iso_8601 = ?
+        ON CONFLICT(username) DO UPDATE SET last_served_unix_ms = ?
         ''', (username, timestamp, timestamp))
+        scheduler.mark_served(username, timestamp)
 
-        return job_id, request_json
-    
-    def complete_job(job_id, result_json):
+        notify_job_changed(job_id)
+
+        return job_id, request_json, attempt, trace_id, timestamp
+
+    def claim_jobs(executor, max_jobs):
+        # Claim up to 'max_jobs' jobs in fair-share order, returning a list of
+        # (job_id, request_json, attempt, trace_id, claimed_at_unix_ms) tuples.
+        claimed = []
+        while len(claimed) < max_jobs:
+            job = claim_job(executor)
+            if job is None:
+                break
+            claimed.append(job)
+        return claimed
+
+    def renew_leases(executor, leases):
+        # Renews the executor's leases on the given (job_id, attempt) pairs, and returns those
+        # which it no longer holds, because the job has been deleted, or its lease ran out and it
+        # has been requeued.
+        c = con.cursor()
+        expires_at = curr_unix_ms() + int(args.lease_duration * 1000)
+        lost = []
+        for job_id, attempt in leases:
+            renewed = c.execute('''
+            UPDATE jobs
+            SET expires_at_unix_ms = ?
+            WHERE id = ? AND state = 'claimed' AND claimed_by = ? AND attempts = ?
+            ''', (expires_at, job_id, executor, attempt)).rowcount
+            if renewed == 0:
+                lost.append((job_id, attempt))
+        return lost
+
+    def leased_since(job_id, executor, attempt):
+        # Returns when the executor claimed the job, if it still holds the lease on it, or None.
+        # 'attempt' may be None for executors which predate leases.
         c = con.cursor()
+        c.execute('''
+        SELECT attempts, claimed_at_unix_ms FROM jobs
+        WHERE id = ? AND state = 'claimed' AND claimed_by = ?
+        ''', (job_id, executor))
+        result = c.fetchone()
+        if result is None or (attempt is not None and result[0] != attempt):
+            return None
+        return result[1]
+
+    def holds_lease(job_id, executor, attempt):
+        return leased_since(job_id, executor, attempt) is not None
+
+    def expire_lease(job_id):
+        # Requeue a claimed job whose lease has run out, or fail it if it has been attempted too
+        # many times already.
+        c = con.cursor()
+        c.execute('''
+        SELECT username, submitted_at_unix_ms, attempts, claimed_at_unix_ms, trace_id FROM jobs
+        WHERE id = ? AND state = 'claimed'
+        ''', (job_id,))
+        username, submitted_at, attempts, claimed_at, trace_id = c.fetchone()
+        live_logs.discard(job_id)
+        record_spans(job_id, trace_id, attempts, [("lease_expired", claimed_at, curr_unix_ms())])
+
+        if attempts >= args.max_attempts:
+            result = {
+                "success": False,
+                "compile_log": "",
+                "execute_log": f"Job abandoned after {attempts} attempts: the executors running it stopped responding.",
+                "lease_expired": True,
+            }
+            store_result(job_id, db.compress_result(result))
+            return
 
         c.execute('''
         UPDATE jobs
-        SET state = 'complete', completed_at_iso_8601 = ?, result_json = ?
+        SET state = 'pending', claimed_at_unix_ms = NULL, expires_at_unix_ms = NULL, claimed_by = NULL
         WHERE id = ?
-        ''', (curr_timestamp(), json.dumps(result_json), job_id))
-    
-    def garbage_collect():
-        c = con.cursor()
+        ''', (job_id,))
+        scheduler.add(job_id, username, submitted_at)
 
-        current_time = datetime.now(timezone.utc).isoformat()
+        job_available.notify_all()
+        notify_job_changed(job_id)
 
-        # Delete completed jobs that are older than max_completed_job_age
+    def store_result(job_id, result_zlib):
+        # Marks a claimed job as complete with the given result.
+        c = con.cursor()
+        timestamp = curr_unix_ms()
+        c.execute('''
+        UPDATE jobs
+        SET state = 'complete', completed_at_unix_ms = ?, expires_at_unix_ms = ?, claimed_by = NULL
+        WHERE id = ?
+        ''', (timestamp, timestamp + max_completed_job_age * 1000, job_id))
         c.execute('''
+        INSERT OR REPLACE INTO job_results (job_id, result_zlib)
+        VALUES (?, ?)
+        ''', (job_id, result_zlib))
+        live_logs.discard(job_id)
+
+        notify_job_changed(job_id)
+
+    def complete_job(job_id, executor, attempt, result, result_zlib, spans):
+        # 'result_zlib' is 'result' compressed with 'db.compress_result', which is done by the
+        # caller so that it does not happen while holding the lock. 'spans' is a list of
+        # {"name": ..., "start_unix_ms": ..., "end_unix_ms": ...} objects describing how the
+        # executor spent its time on the job. A span whose end is missing ends now; the executor
+        # uses this for the upload of the result itself.
+        nonlocal current_toolchain
+        c = con.cursor()
+
+        # Results are only accepted from the executor currently holding the job's lease, so that
+        # an executor which was presumed dead cannot complete a job which has since been requeued.
+        claimed_at = leased_since(job_id, executor, attempt)
+        if claimed_at is None:
+            return
+        if isinstance(result.get("toolchain"), str):
+            current_toolchain = result["toolchain"]
+        timestamp = curr_unix_ms()
+        metrics.observe_complete((timestamp - claimed_at) / 1000)
+
+        if len(spans) > 0:
+            c.execute('''
+            SELECT trace_id FROM jobs
+            WHERE id = ?
+            ''', (job_id,))
+            trace_id = c.fetchone()[0]
+            record_spans(job_id, trace_id, attempt, [
+                (str(span["name"]), int(span["start_unix_ms"]), int(span.get("end_unix_ms") or timestamp))
+                for span in spans
+            ])
+
+        # Remember sources which the executor reports as failing to compile.
+        if result.get("compile_failed"):
+            c.execute('''
+            SELECT request_json FROM jobs
+            WHERE id = ?
+            ''', (job_id,))
+            record_compile_failure(json.loads(c.fetchone()[0]), result)
+
+        store_result(job_id, result_zlib)
+
+    def garbage_collect(batch_size):
+        # Handle up to 'batch_size' claimed and completed jobs whose expiry time has passed:
+        # requeue (or fail) claimed jobs whose leases have run out, and delete completed jobs.
+        # Also deletes up to 'batch_size' expired compile failures. Returns (rows deleted, leases
+        # expired, whether a batch was full), where a full batch means more may be left to do.
+        c = con.cursor()
+
+        c.execute(db.expired_jobs_query, (curr_unix_ms(), batch_size))
+        expired = c.fetchall()
+        leases_expired = 0
+        for job_id, state in expired:
+            if state == "claimed":
+                expire_lease(job_id)
+                leases_expired += 1
+        deleted = c.executemany('''
         DELETE FROM jobs
-        WHERE state = 'complete' AND
-            datetime(completed_at_iso_8601) < datetime(?, '-' || ? || ' seconds')
-        ''', (current_time, max_completed_job_age,))
+        WHERE id = ? AND state = 'complete'
+        ''', [(job_id,) for job_id, state in expired if state == "complete"]).rowcount
+
+        for job_id, state in expired:
+            if state == "complete":
+                notify_job_changed(job_id)
 
-        # Delete claimed jobs that are older than max_claimed_job_age
+        failures_deleted = c.execute(f'''
+        DELETE FROM compile_failures
+        WHERE rowid IN ({db.expired_compile_failures_query})
+        ''', (curr_unix_ms(), batch_size)).rowcount
+
+        full = len(expired) == batch_size or failures_deleted == batch_size
+        return deleted + failures_deleted, leases_expired, full
+
+    def append_live_log(job_id, executor, attempt, offset, text):
+        # Output is only accepted for jobs which are still running, from the executor running them.
+        if not holds_lease(job_id, executor, attempt):
+            return
+        live_logs.append(job_id, offset, text)
+        live_log_waiters.notify(job_id)
+
+    def trim_compile_failures():
+        # Keep only the 'max_compile_failures' most recently recorded compile failures.
+        c = con.cursor()
         c.execute('''
-        DELETE FROM jobs
-        WHERE state = 'claimed' AND
-            datetime(claimed_at_iso_8601) < datetime(?, '-' || ? || ' seconds')
-        ''', (current_time, max_claimed_job_age,))
+        DELETE FROM compile_failures
+        WHERE rowid IN (
+            SELECT rowid FROM compile_failures
+            ORDER BY expires_at_unix_ms DESC
+            LIMIT -1 OFFSET ?
+        )
+        ''', (max_compile_failures,))
+
+    def reaper():
+        while True:
+            time.sleep(args.gc_interval)
+            try:
+                # Delete in batches, releasing the lock in between, so that a large backlog of
+                # expired jobs never stalls request handling for long.
+                while True:
+                    started = time.monotonic()
+                    with transaction():
+                        deleted, leases_expired, full = garbage_collect(args.gc_batch_size)
+                    metrics.observe_gc(time.monotonic() - started, deleted, leases_expired)
+                    if not full:
+                        break
+                with transaction():
+                    trim_compile_failures()
+            except Exception as e:
+                traceback.print_exc()
     
     def get_job_status(job_id):
-        # returns a tuple of (state, result_json)
+        # returns the job's state, or None if the job does not exist
+        c = con.cursor()
+        c.execute('''
+        SELECT state FROM jobs
+        WHERE id = ?
+        ''', (job_id,))
+        result = c.fetchone()
+        if result is None:
+            return None
+        return result[0]
+
+    def get_job_attempt(job_id):
+        # returns how many times the job has been claimed, or None if the job does not exist
+        c = con.cursor()
+        c.execute('''
+        SELECT attempts FROM jobs
+        WHERE id = ?
+        ''', (job_id,))
+        result = c.fetchone()
+        if result is None:
+            return None
+        return result[0]
+
+    def get_job_trace(job_id):
+        # returns the job's (trace_id, submitted_at_unix_ms, spans), or None if the job does not
+        # exist
         c = con.cursor()
         c.execute('''
-        SELECT state, result_json FROM jobs
+        SELECT trace_id, submitted_at_unix_ms FROM jobs
         WHERE id = ?
         ''', (job_id,))
-        return c.fetchone()
+        result = c.fetchone()
+        if result is None:
+            return None
+        trace_id, submitted_at = result
+        c.execute(db.job_spans_query, (job_id,))
+        return trace_id, submitted_at, c.fetchall()
+
+    def count_jobs_by_user():
+        # Returns {username: {state: count}}. This reads the whole jobs table, which only ever
+        # holds a few jobs per user, since pending jobs replace each other and completed jobs are
+        # deleted after 'max_completed_job_age'.
+        c = con.cursor()
+        c.execute('''
+        SELECT username, state, COUNT(*) FROM jobs
+        GROUP BY username, state
+        ''')
+        counts = {}
+        for username, state, count in c.fetchall():
+            counts.setdefault(username, {"pending": 0, "claimed": 0, "complete": 0})[state] = count
+        return counts
+
+    def get_job_result(job_id):
+        # returns the job's compressed result, or None if the job is not complete
+        c = con.cursor()
+        c.execute('''
+        SELECT result_zlib FROM job_results
+        WHERE job_id = ?
+        ''', (job_id,))
+        result = c.fetchone()
+        if result is None:
+            return None
+        return result[0]
 
     class Handler(http.server.BaseHTTPRequestHandler):
-        def _set_headers(self, code=200):
+        # Keep connections open between requests (HTTP/1.1 keep-alive), so that clients can skip
+        # the TCP and TLS handshakes on subsequent requests.
+        protocol_version = "HTTP/1.1"
+        timeout = request_timeout
+        # Buffer each response so that its headers and body are sent together, and send it
+        # immediately rather than waiting on Nagle's algorithm.
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            super().setup()
+            # The listening socket does not perform the TLS handshake on accept, so that a slow
+            # handshake only ever blocks this connection's thread.
+            self.connection.do_handshake()
+
+        def _send_json(self, code, response):
+            # 'response' is either a JSON-serializable object, or a JSON body which has already been
+            # serialized, as results are stored.
+            encodings = accepted_encodings(self.headers.get('Accept-Encoding'))
+            content_encoding = None
+            if isinstance(response, bytes):
+                body = response
+            else:
+                body = json.dumps(response).encode()
+            if len(body) >= min_compress_size:
+                if "gzip" in encodings:
+                    body = gzip.compress(body, compresslevel=6)
+                    content_encoding = "gzip"
+                elif "deflate" in encodings:
+                    body = zlib.compress(body)
+                    content_encoding = "deflate"
             self.send_response(code)
             self.send_header('Content-type', 'application/json')
+            if content_encoding is not None:
+                self.send_header('Content-Encoding', content_encoding)
+            self.send_header('Content-Length', str(len(body)))
+            if not self._body_read and int(self.headers.get('Content-Length', 0)) > 0:
+                # The request body was never consumed, so the connection cannot be reused.
+                self.send_header('Connection', 'close')
+                self.close_connection = True
             self.end_headers()
+            self.wfile.write(body)
+
+        def _read_body(self, limit):
+            # Returns the decoded request body, or None if it is larger than 'limit' bytes, either
+            # as sent or once decoded.
+            content_length = int(self.headers['Content-Length'])
+            if content_length > limit:
+                return None
+            data = self.rfile.read(content_length)
+            self._body_read = True
+            content_encoding = self.headers.get('Content-Encoding')
+            if content_encoding is not None:
+                content_encoding = content_encoding.strip().lower()
+            return decode_request_body(data, content_encoding, limit)
 
-        def _authenticate_user(self, username, token):
-            if not authenticate_user(username, token):
-                self._set_headers(401)
-                self.wfile.write(json.dumps({
-                    "error": "Invalid username or token"
-                }).encode())
-                return False
-            return True
-
-        def _authenticate_executor(self, executor, token):
-            if not authenticate_executor(executor, token):
-                self._set_headers(401)
-                self.wfile.write(json.dumps({
-                    "error": "Invalid executor or token"
-                }).encode())
-                return False
-            return True
-        
         def do_GET(self):
+            self._body_read = False
+            started = time.monotonic()
             try:
                 # Get the path and query arguments from the URL
                 url_parts = urlparse(self.path)
@@ -190,39 +818,26 @@ def main():
                 query_args = parse_qs(url_parts.query)
 
                 if path.startswith("/api/status"):
-                    with con:
-                        garbage_collect()
-
-                        username = query_args["username"][0]
-                        token = query_args["token"][0]
-                        if not self._authenticate_user(username, token):
-                            return
-
-                        job_id = query_args["job_id"][0]
-
-                        state, result_json = get_job_status(job_id)
-
-                    self._set_headers()
-                    self.wfile.write(json.dumps({
-                        "success": True,
-                        "state": state,
-                        "result": result_json,
-                    }).encode())
-                    return
+                    code, response = self._handle_status(query_args)
+                elif path.startswith("/api/result"):
+                    code, response = self._handle_result(query_args)
+                elif path.startswith("/api/log"):
+                    code, response = self._handle_get_log(query_args)
+                elif path.startswith("/api/metrics"):
+                    code, response = self._handle_metrics(query_args)
+                elif path.startswith("/api/trace"):
+                    code, response = self._handle_trace(query_args)
                 else:
-                    self._set_headers(404)
-                    self.wfile.write(json.dumps({
-                        "error": "Invalid path"
-                    }).encode())
-                    return
+                    code, response = 404, {"error": "Invalid path"}
             except Exception as e:
                 traceback.print_exc()
-                self._set_headers(400)
-                self.wfile.write(json.dumps({
-                    "error": str(e)
-                }).encode())
+                code, response = 400, {"error": str(e)}
+            self._send_json(code, response)
+            self._observe_request(started, code)
 
         def do_POST(self):
+            self._body_read = False
+            started = time.monotonic()
             try:
                 # Get the path and query arguments from the URL
                 url_parts = urlparse(self.path)
@@ -230,143 +845,404 @@ def main():
                 query_args = parse_qs(url_parts.query)
 
                 if path.startswith("/api/submit"):
-                    with con:
-                        garbage_collect()
-
-                        username = query_args["username"][0]
-                        token = query_args["token"][0]
-                        if not self._authenticate_user(username, token):
-                            return
-                        
-                        content_length = int(self.headers['Content-Length'])
-                        if content_length > max_submit_size:
-                            self._set_headers(400)
-                            self.wfile.write(json.dumps({
-                                "error": "Request too large"
-                            }).encode())
-                            return
-                        post_data = self.rfile.read(content_length)
-                        post_data = json.loads(post_data.decode())
-
-                        audit_log.write(json.dumps({
-                            "timestamp": curr_timestamp(),
-                            "username": username,
-                            "action": "submit",
-                            "request": post_data,
-                        }))
-                        audit_log.write("\n")
-                        audit_log.flush()
-
-                        if has_pending_job(username):
-                            if "override_pending" not in query_args:
-                                self._set_headers(400)
-                                self.wfile.write(json.dumps({
-                                    "error": "pending_job"
-                                }).encode())
-                                return
-                        
-                        job_id = submit_job(username, post_data)
-
-                    self._set_headers()
-                    self.wfile.write(json.dumps({
-                        "success": True,
-                        "job_id": job_id,
-                    }).encode())
-                    return
+                    code, response = self._handle_submit(query_args)
                 elif path.startswith("/api/delete"):
-                    with con:
-                        garbage_collect()
-
-                        username = query_args["username"][0]
-                        token = query_args["token"][0]
-                        if not self._authenticate_user(username, token):
-                            return
-                        
-                        job_id = query_args["job_id"][0]
-
-                        delete_job(job_id)
-
-                    self._set_headers()
-                    self.wfile.write(json.dumps({
-                        "success": True,
-                    }).encode())
-                    return
+                    code, response = self._handle_delete(query_args)
                 elif path.startswith("/api/claim"):
-                    with con:
-                        garbage_collect()
+                    code, response = self._handle_claim(query_args)
+                elif path.startswith("/api/complete"):
+                    code, response = self._handle_complete(query_args)
+                elif path.startswith("/api/log"):
+                    code, response = self._handle_append_log(query_args)
+                elif path.startswith("/api/heartbeat"):
+                    code, response = self._handle_heartbeat(query_args)
+                else:
+                    code, response = 404, {"error": "Invalid path"}
+            except Exception as e:
+                traceback.print_exc()
+                code, response = 400, {"error": str(e)}
+            self._send_json(code, response)
+            self._observe_request(started, code)
+
+        def _observe_request(self, started, code):
+            path = urlparse(self.path).path
+            path = next((prefix for prefix in metrics_paths if path.startswith(prefix)), "other")
+            metrics.observe_request(self.command, path, code, time.monotonic() - started)
+
+        def _handle_status(self, query_args):
+            username = query_args["username"][0]
+            token = query_args["token"][0]
+            job_id = int(query_args["job_id"][0])
+
+            # If 'wait' is given, hold the request open for up to that many seconds until the
+            # job's state differs from 'state' (the state the client already knows about).
+            wait = min(float(query_args.get("wait", ["0"])[0]), max_status_wait)
+            known_state = query_args.get("state", [None])[0]
+            deadline = time.monotonic() + wait
+
+            with transaction():
+                if not authenticate_user(username, token):
+                    return 401, {"error": "Invalid username or token"}
+
+            with db_lock:
+                while True:
+                    state = get_job_status(job_id)
+                    remaining = deadline - time.monotonic()
+                    if state is None or state != known_state or remaining <= 0:
+                        break
+                    status_waiters.wait(job_id, remaining)
+
+                # Clients which don't long-poll predate '/api/result', and expect a completed job's
+                # result in the status, JSON-encoded as the executor used to upload it.
+                legacy_result = None
+                if "wait" not in query_args and state == "complete" and job_owner(job_id) == username:
+                    result_zlib = get_job_result(job_id)
+                    if result_zlib is not None:
+                        legacy_result = '{"result_json": ' + zlib.decompress(result_zlib).decode() + '}'
+
+            if legacy_result is not None:
+                return 200, {
+                    "success": True,
+                    "state": state,
+                    "result": legacy_result,
+                }
+
+            # The result itself is fetched separately from '/api/result' once the job is complete,
+            # so that polling never transfers it.
+            return 200, {
+                "success": True,
+                "state": state,
+            }
+
+        def _handle_metrics(self, query_args):
+            admin = query_args["admin"][0]
+            token = query_args["token"][0]
 
-                        executor = query_args["executor"][0]
-                        token = query_args["token"][0]
+            with transaction():
+                if not authenticate_admin(admin, token):
+                    return 401, {"error": "Invalid admin or token"}
 
-                        if not self._authenticate_executor(executor, token):
-                            return
-                        
-                        job_id, request_json = claim_job(executor)
+                jobs_by_user = count_jobs_by_user()
 
-                    self._set_headers()
-                    if job_id is not None:
-                        self.wfile.write(json.dumps({
-                            "success": True,
+            return 200, {
+                "success": True,
+                **metrics.to_json(),
+                "jobs_by_user": jobs_by_user,
+            }
+
+        def _handle_trace(self, query_args):
+            username = query_args["username"][0]
+            token = query_args["token"][0]
+            job_id = int(query_args["job_id"][0])
+
+            with transaction():
+                if not authenticate_user(username, token):
+                    return 401, {"error": "Invalid username or token"}
+
+                if job_owner(job_id) != username:
+                    return 404, {"error": "No such job"}
+
+                trace_id, submitted_at, spans = get_job_trace(job_id)
+
+            return 200, {
+                "success": True,
+                "trace_id": trace_id,
+                "submitted_at_unix_ms": submitted_at,
+                "spans": [
+                    {"attempt": attempt, "name": name, "start_unix_ms": start, "end_unix_ms": end}
+                    for attempt, name, start, end in spans
+                ],
+            }
+
+        def _handle_result(self, query_args):
+            username = query_args["username"][0]
+            token = query_args["token"][0]
+            job_id = int(query_args["job_id"][0])
+
+            with transaction():
+                if not authenticate_user(username, token):
+                    return 401, {"error": "Invalid username or token"}
+
+                if job_owner(job_id) != username:
+                    return 404, {"error": "No such job"}
+
+                result_zlib = get_job_result(job_id)
+
+            if result_zlib is None:
+                return 404, {"error": "No result available"}
+
+            # The result is stored as JSON, so it is spliced into the response as-is rather than
+            # being parsed and serialized again.
+            return 200, b'{"success": true, "result": ' + zlib.decompress(result_zlib) + b'}'
+
+        def _handle_get_log(self, query_args):
+            username = query_args["username"][0]
+            token = query_args["token"][0]
+            job_id = int(query_args["job_id"][0])
+
+            # Returns the job's live output from character 'offset' onwards. If 'wait' is given,
+            # hold the request open for up to that many seconds until there is new output, or the
+            # job is no longer pending or running. If 'attempt' is given, also stop waiting if the
+            # job is requeued, since its live output then starts over.
+            offset = int(query_args.get("offset", ["0"])[0])
+            known_attempt = int(query_args["attempt"][0]) if "attempt" in query_args else None
+            wait = min(float(query_args.get("wait", ["0"])[0]), max_log_wait)
+            deadline = time.monotonic() + wait
+
+            with transaction():
+                if not authenticate_user(username, token):
+                    return 401, {"error": "Invalid username or token"}
+
+                if job_owner(job_id) != username:
+                    return 404, {"error": "No such job"}
+
+            with db_lock:
+                while True:
+                    state = get_job_status(job_id)
+                    attempt = get_job_attempt(job_id)
+                    start, text = live_logs.read(job_id, offset)
+                    remaining = deadline - time.monotonic()
+                    if (
+                        state not in ("pending", "claimed") or
+                        (known_attempt is not None and attempt != known_attempt) or
+                        len(text) > 0 or
+                        start != offset or
+                        remaining <= 0
+                    ):
+                        break
+                    live_log_waiters.wait(job_id, remaining)
+
+            # 'offset' in the response is where 'text' starts, which is later than the requested
+            # offset if some output was dropped in between. 'attempt' identifies which run of the
+            # job the output is from.
+            return 200, {
+                "success": True,
+                "state": state,
+                "attempt": attempt,
+                "offset": start,
+                "text": text,
+            }
+
+        def _handle_append_log(self, query_args):
+            executor = query_args["executor"][0]
+            token = query_args["token"][0]
+
+            with transaction():
+                if not authenticate_executor(executor, token):
+                    return 401, {"error": "Invalid executor or token"}
+
+            body = self._read_body(max_complete_size)
+            if body is None:
+                return 400, {"error": "Request too large"}
+            post_data = json.loads(body.decode())
+
+            # The body is a batch of {"job_id": ..., "offset": ..., "text": ...} objects under
+            # 'logs', each giving output of a running job starting at character 'offset'.
+            with transaction():
+                for log in post_data["logs"]:
+                    append_live_log(int(log["job_id"]), executor, log.get("attempt"), int(log["offset"]), log["text"])
+
+            return 200, {
+                "success": True,
+            }
+
+        def _handle_heartbeat(self, query_args):
+            executor = query_args["executor"][0]
+            token = query_args["token"][0]
+
+            with transaction():
+                if not authenticate_executor(executor, token):
+                    return 401, {"error": "Invalid executor or token"}
+
+            body = self._read_body(max_submit_size)
+            if body is None:
+                return 400, {"error": "Request too large"}
+            post_data = json.loads(body.decode())
+
+            # The body lists the jobs the executor is working on under 'leases', as
+            # {"job_id": ..., "attempt": ...} objects, and renews the executor's leases on them.
+            # Those it no longer holds, because they have been cancelled or requeued, are returned
+            # under 'cancelled', for the executor to stop.
+            leases = [(int(lease["job_id"]), int(lease["attempt"])) for lease in post_data["leases"]]
+
+            with transaction():
+                lost = renew_leases(executor, leases)
+
+            return 200, {
+                "success": True,
+                "cancelled": [
+                    {"job_id": job_id, "attempt": attempt}
+                    for job_id, attempt in lost
+                ],
+            }
+
+        def _handle_submit(self, query_args):
+            username = query_args["username"][0]
+            token = query_args["token"][0]
+
+            with transaction():
+                if not authenticate_user(username, token):
+                    return 401, {"error": "Invalid username or token"}
+
+            body = self._read_body(max_submit_size)
+            if body is None:
+                return 400, {"error": "Request too large"}
+            post_data = json.loads(body.decode())
+
+            with transaction():
+                audit_log.write(json.dumps({
+                    "timestamp": curr_timestamp(),
+                    "username": username,
+                    "action": "submit",
+                    "request": post_data,
+                }))
+                audit_log.write("\n")
+                audit_log.flush()
+
+                # The pending job's id is returned, for the client to name it in 'replace_job_id'
+                # when overriding it.
+                pending_job_id = pending_job(username)
+                if pending_job_id is not None and "override_pending" not in query_args:
+                    return 400, {"error": "pending_job", "job_id": pending_job_id}
+
+                replace_job_id = int(query_args["replace_job_id"][0]) if "replace_job_id" in query_args else None
+                job_id, trace_id = submit_job(username, post_data, replace_job_id=replace_job_id)
+
+            return 200, {
+                "success": True,
+                "job_id": job_id,
+                "trace_id": trace_id,
+            }
+
+        def _handle_delete(self, query_args):
+            username = query_args["username"][0]
+            token = query_args["token"][0]
+            job_id = int(query_args["job_id"][0])
+
+            with transaction():
+                if not authenticate_user(username, token):
+                    return 401, {"error": "Invalid username or token"}
+
+                if job_owner(job_id) != username:
+                    return 404, {"error": "No such job"}
+
+                delete_job(job_id)
+
+            return 200, {
+                "success": True,
+            }
+
+        def _handle_claim(self, query_args):
+            executor = query_args["executor"][0]
+            token = query_args["token"][0]
+
+            # If 'wait' is given, hold the request open for up to that many seconds until a job
+            # becomes available, rather than returning immediately when the queue is empty.
+            wait = min(float(query_args.get("wait", ["0"])[0]), max_claim_wait)
+            deadline = time.monotonic() + wait
+
+            # If 'max' is given, atomically claim up to that many jobs, and return them as a list
+            # under 'jobs'. Otherwise claim at most one job.
+            batch = "max" in query_args
+            max_jobs = min(int(query_args["max"][0]), max_claim_batch) if batch else 1
+
+            with transaction():
+                if not authenticate_executor(executor, token):
+                    return 401, {"error": "Invalid executor or token"}
+
+            with job_available:
+                while True:
+                    with transaction():
+                        claimed = claim_jobs(executor, max_jobs)
+                    remaining = deadline - time.monotonic()
+                    if len(claimed) > 0 or remaining <= 0:
+                        break
+                    job_available.wait(remaining)
+
+            if batch:
+                return 200, {
+                    "success": True,
+                    "jobs": [
+                        {
                             "job_id": job_id,
                             "request_json": json.loads(request_json),
-                        }).encode())
-                    else:
-                        self.wfile.write(json.dumps({
-                            "success": True,
-                            "job_id": None,
-                        }).encode())
-                    return
-                elif path.startswith("/api/complete"):
-                    with con:
-                        garbage_collect()
-
-                        executor = query_args["executor"][0]
-                        token = query_args["token"][0]
-
-                        if not self._authenticate_executor(executor, token):
-                            return
-                        
-                        job_id = query_args["job_id"][0]
-                        content_length = int(self.headers['Content-Length'])
-                        post_data = self.rfile.read(content_length)
-                        post_data = json.loads(post_data.decode())
-
-                        complete_job(job_id, post_data)
-
-                    self._set_headers()
-                    self.wfile.write(json.dumps({
-                        "success": True,
-                    }).encode())
-                    return
-                else:
-                    self._set_headers(404)
-                    self.wfile.write(json.dumps({
-                        "error": "Invalid path"
-                    }).encode())
-                    return
-            except Exception as e:
-                traceback.print_exc()
-                self._set_headers(400)
-                self.wfile.write(json.dumps({
-                    "error": str(e)
-                }).encode())
+                            "attempt": attempt,
+                            "trace_id": trace_id,
+                            "claimed_at_unix_ms": claimed_at,
+                        }
+                        for job_id, request_json, attempt, trace_id, claimed_at in claimed
+                    ],
+                }
+            if len(claimed) == 0:
+                return 200, {
+                    "success": True,
+                    "job_id": None,
+                }
+            job_id, request_json, attempt, trace_id, claimed_at = claimed[0]
+            return 200, {
+                "success": True,
+                "job_id": job_id,
+                "request_json": json.loads(request_json),
+                "attempt": attempt,
+                "trace_id": trace_id,
+                "claimed_at_unix_ms": claimed_at,
+            }
+
+        def _handle_complete(self, query_args):
+            executor = query_args["executor"][0]
+            token = query_args["token"][0]
+
+            # Authenticate before reading the body, so that decoding and compressing results, which
+            # may be large, is only ever done for executors.
+            with transaction():
+                if not authenticate_executor(executor, token):
+                    return 401, {"error": "Invalid executor or token"}
+
+            body = self._read_body(max_complete_size)
+            if body is None:
+                return 400, {"error": "Request too large"}
+            post_data = json.loads(body.decode())
 
-    port = 4443
+            # Results are either for the single job named by 'job_id', or given as a batch in the
+            # body, as a list of {"job_id": ..., "attempt": ..., "result_json": ..., "spans": ...}
+            # objects under 'results'.
+            if "job_id" in query_args:
+                results = [(int(query_args["job_id"][0]), None, post_data["result_json"], [])]
+            else:
+                results = [
+                    (result["job_id"], result.get("attempt"), result["result_json"], result.get("spans", []))
+                    for result in post_data["results"]
+                ]
+            results = [
+                (job_id, attempt, result, db.compress_result(result), spans)
+                for job_id, attempt, result, spans in results
+            ]
 
-    httpd = http.server.HTTPServer(('', port), Handler)
+            with transaction():
+                for job_id, attempt, result, result_zlib, spans in results:
+                    complete_job(job_id, executor, attempt, result, result_zlib, spans)
 
-    cert_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cert")
+            return 200, {
+                "success": True,
+            }
 
-    certfile = os.path.join(cert_dir, "server.crt")
-    keyfile = os.path.join(cert_dir, "server.key")
+    class Server(http.server.ThreadingHTTPServer):
+        request_queue_size = listen_backlog
 
-    httpd.socket = ssl.wrap_socket(
+    port = args.port
+
+    httpd = Server((args.host, port), Handler)
+
+    ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_ctx.load_cert_chain(certfile=args.certfile, keyfile=args.keyfile)
+    httpd.socket = ssl_ctx.wrap_socket(
         httpd.socket,
-        certfile=certfile,
-        keyfile=keyfile,
         server_side=True,
+        do_handshake_on_connect=False,
     )
 
+    threading.Thread(target=reaper, daemon=True).start()
+
     print("serving at port", port)
     httpd.serve_forever()
 
@@ -0,0 +1,99 @@
+import bisect
+import threading
+
+# Upper bounds of the buckets of histograms of request handling and database times.
+latency_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30] # seconds
+
+# Upper bounds of the buckets of histograms of how long jobs wait in the queue and run.
+wait_buckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600] # seconds
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Number of observations in each bucket, the last one being unbounded.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_json(self):
+        # Bucket counts are cumulative, as in Prometheus: each counts the observations less than or
+        # equal to its upper bound.
+        cumulative = []
+        total = 0
+        for le, n in zip(self.buckets + ["+Inf"], self.counts):
+            total += n
+            cumulative.append([le, total])
+        return {"buckets": cumulative, "count": self.count, "sum": self.sum}
+
+class ServerMetrics:
+    # Counters and histograms describing the queue server's load, kept in memory since startup.
+    # Recording is cheap and never touches the database; it has its own lock, so that it never
+    # contends with the database lock.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (method, path) -> {status code: count}
+        self.request_counts = {}
+        # (method, path) -> Histogram of request handling times
+        self.request_seconds = {}
+        self.transaction_seconds = Histogram(latency_buckets)
+        self.gc_seconds = Histogram(latency_buckets)
+        self.gc_rows_deleted = 0
+        # Claimed jobs requeued (or failed) by garbage collection because their leases ran out.
+        self.gc_leases_expired = 0
+        # How long jobs wait from submission until they are claimed, and from being claimed until
+        # they complete.
+        self.submit_to_claim_seconds = Histogram(wait_buckets)
+        self.claim_to_complete_seconds = Histogram(wait_buckets)
+
+    def observe_request(self, method, path, code, seconds):
+        key = (method, path)
+        with self.lock:
+            counts = self.request_counts.setdefault(key, {})
+            counts[code] = counts.get(code, 0) + 1
+            if key not in self.request_seconds:
+                self.request_seconds[key] = Histogram(latency_buckets)
+            self.request_seconds[key].observe(seconds)
+
+    def observe_transaction(self, seconds):
+        with self.lock:
+            self.transaction_seconds.observe(seconds)
+
+    def observe_gc(self, seconds, rows_deleted, leases_expired):
+        with self.lock:
+            self.gc_seconds.observe(seconds)
+            self.gc_rows_deleted += rows_deleted
+            self.gc_leases_expired += leases_expired
+
+    def observe_claim(self, submit_to_claim_seconds):
+        with self.lock:
+            self.submit_to_claim_seconds.observe(submit_to_claim_seconds)
+
+    def observe_complete(self, claim_to_complete_seconds):
+        with self.lock:
+            self.claim_to_complete_seconds.observe(claim_to_complete_seconds)
+
+    def to_json(self):
+        with self.lock:
+            return {
+                "requests": [
+                    {
+                        "method": method,
+                        "path": path,
+                        "counts": {str(code): n for code, n in sorted(self.request_counts[(method, path)].items())},
+                        "seconds": self.request_seconds[(method, path)].to_json(),
+                    }
+                    for method, path in sorted(self.request_counts)
+                ],
+                "transaction_seconds": self.transaction_seconds.to_json(),
+                "gc_seconds": self.gc_seconds.to_json(),
+                "gc_rows_deleted": self.gc_rows_deleted,
+                "gc_leases_expired": self.gc_leases_expired,
+                "submit_to_claim_seconds": self.submit_to_claim_seconds.to_json(),
+                "claim_to_complete_seconds": self.claim_to_complete_seconds.to_json(),
+            }
@@ -0,0 +1,81 @@
+import heapq
+
+import submission_queue.db as db
+
+class FairShareScheduler:
+    # In-memory index of the pending jobs in the queue, ordered by the least-recently-served
+    # policy: jobs of users who have never been served come first, in order of submission, followed
+    # by jobs of users who have been served, in order of when they were last served.
+    #
+    # SQLite remains the durable record. The scheduler is rebuilt from the database on startup, and
+    # must be kept in sync by calling 'add', 'remove' and 'pop' from within the same transactions
+    # that insert, delete and claim pending jobs.
+
+    def __init__(self):
+        # job_id -> (username, submitted_at_unix_ms)
+        self.pending = {}
+        # username -> last_served_unix_ms, for users who have been served
+        self.last_served = {}
+        # Heap of (never_served, last_served_unix_ms, submitted_at_unix_ms, job_id) entries.
+        # Entries are removed lazily: an entry is stale if its job is no longer pending, or if its
+        # user has been served since it was pushed.
+        self.heap = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def rebuild(self, cur):
+        cur.execute('''
+        SELECT username, last_served_unix_ms FROM priorities
+        WHERE last_served_unix_ms IS NOT NULL
+        ''')
+        self.last_served = dict(cur.fetchall())
+
+        cur.execute(db.pending_jobs_query)
+        self.pending = {
+            job_id: (username, submitted_at)
+            for job_id, username, submitted_at in cur.fetchall()
+        }
+
+        self.heap = [self._entry(job_id) for job_id in self.pending]
+        heapq.heapify(self.heap)
+
+    def _entry(self, job_id):
+        username, submitted_at = self.pending[job_id]
+        last_served = self.last_served.get(username)
+        if last_served is None:
+            return (0, submitted_at, submitted_at, job_id)
+        return (1, last_served, submitted_at, job_id)
+
+    def add(self, job_id, username, submitted_at):
+        self.pending[job_id] = (username, submitted_at)
+        heapq.heappush(self.heap, self._entry(job_id))
+
+    def remove(self, job_id):
+        if self.pending.pop(job_id, None) is None:
+            return
+        # Compact the heap once stale entries make up most of it.
+        if len(self.heap) > 2 * len(self.pending) + 64:
+            self.heap = [self._entry(pending_id) for pending_id in self.pending]
+            heapq.heapify(self.heap)
+
+    def pop(self):
+        # Removes the next job to be served from the pending set, and returns its
+        # (job_id, username), or None if there are no pending jobs.
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            job_id = entry[-1]
+            if job_id not in self.pending:
+                continue
+            # Serving a user only ever moves their remaining jobs later in the order, so an entry
+            # with an outdated key can simply be pushed back with its current key.
+            current = self._entry(job_id)
+            if current != entry:
+                heapq.heappush(self.heap, current)
+                continue
+            username, _ = self.pending.pop(job_id)
+            return job_id, username
+        return None
+
+    def mark_served(self, username, timestamp):
+        self.last_served[username] = timestamp